@@ -0,0 +1,123 @@
+"""批量生成 b40 / sb40 图片，用于群排行榜等需要一次生成很多玩家图片的场合。
+
+玩家数据并发拉取（受 --concurrency 限制），图片在渲染进程池中绘制，结果写入 --out-dir。
+
+在项目根目录运行：
+    python batch_b40.py 12345678 someone -k sb40 -o out/
+    python batch_b40.py -f players.txt --base-url http://127.0.0.1:8000/api/maimaidxprober
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from src.libraries.image import ImageEncoder, encoder_for
+from src.libraries.maimai_best_40 import generate, generate_simple
+from src.libraries.maimaidx_prober import ProberClient, player_cache
+from src.libraries.render_cache import render_cache
+from src.libraries.render_pool import render_pool
+
+GENERATORS = {'b40': generate, 'sb40': generate_simple}
+STATUS_TEXT = {400: '未找到此玩家', 403: '该用户禁止了其他人获取数据'}
+EXTENSIONS = {'PNG': 'png', 'WEBP': 'webp', 'JPEG': 'jpg'}
+
+
+def read_players(args: argparse.Namespace) -> List[str]:
+    players = list(args.players)
+    if args.file:
+        with open(args.file, encoding='utf-8-sig') as f:
+            players += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    # 去重并保持顺序
+    return list(dict.fromkeys(players))
+
+
+def make_payload(player: str, mode: str) -> Dict[str, str]:
+    if mode == 'qq' or (mode == 'auto' and player.isdigit()):
+        return {'qq': player}
+    return {'username': player}
+
+
+def output_path(out_dir: str, kind: str, player: str, encoder: ImageEncoder) -> str:
+    name = re.sub(r'[\\/:*?"<>|\s]', '_', player)
+    return os.path.join(out_dir, f'{kind}_{name}.{EXTENSIONS[encoder.format]}')
+
+
+async def render_one(player: str, args: argparse.Namespace, encoder: ImageEncoder,
+                     semaphore: asyncio.Semaphore) -> Tuple[str, Optional[str], float, int]:
+    """返回 (玩家, 出错原因, 耗时, 图片字节数)"""
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            img, status = await GENERATORS[args.kind](make_payload(player, args.id_type), encoder)
+        except Exception as e:
+            return player, repr(e), time.perf_counter() - start, 0
+        if status:
+            return player, STATUS_TEXT.get(status, str(status)), time.perf_counter() - start, 0
+        with open(output_path(args.out_dir, args.kind, player, encoder), 'wb') as f:
+            f.write(img.data)
+        return player, None, time.perf_counter() - start, img.size
+
+
+async def run(args: argparse.Namespace) -> int:
+    players = read_players(args)
+    if not players:
+        print('没有要生成的玩家', file=sys.stderr)
+        return 2
+    os.makedirs(args.out_dir, exist_ok=True)
+    encoder = ImageEncoder.from_config(args.encoding) if args.encoding else encoder_for(args.kind)
+    player_cache.client = ProberClient(args.base_url, limit=args.concurrency, limit_per_host=args.concurrency)
+    if args.workers is not None:
+        render_pool.workers = args.workers
+    if args.no_render_cache:
+        render_cache.maxbytes = 0
+        render_cache.cache_dir = None
+    semaphore = asyncio.Semaphore(args.concurrency)
+    start = time.perf_counter()
+    try:
+        tasks = [asyncio.ensure_future(render_one(player, args, encoder, semaphore)) for player in players]
+        failed = 0
+        total_bytes = 0
+        for task in asyncio.as_completed(tasks):
+            player, error, seconds, size = await task
+            if error is None:
+                total_bytes += size
+                print(f'{player}\t{seconds:.2f}s\t{size / 1024:.1f} KiB')
+            else:
+                failed += 1
+                print(f'{player}\t{seconds:.2f}s\t失败：{error}')
+    finally:
+        await player_cache.client.close()
+        render_pool.shutdown()
+    elapsed = time.perf_counter() - start
+    done = len(players) - failed
+    print(f'共 {len(players)} 个玩家，成功 {done} 个，失败 {failed} 个；用时 {elapsed:.2f}s，'
+          f'{done / elapsed:.2f} 张/秒，{total_bytes / 1024 / 1024 / elapsed:.2f} MiB/秒')
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='批量生成 b40 / sb40 图片')
+    parser.add_argument('players', nargs='*', help='qq 号或查分器用户名')
+    parser.add_argument('-f', '--file', help='玩家列表文件，每行一个，# 开头的行忽略')
+    parser.add_argument('-k', '--kind', choices=sorted(GENERATORS), default='b40')
+    parser.add_argument('-o', '--out-dir', default='b40_output')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='同时进行的查询数')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='渲染进程数，0 表示在单个线程中渲染；默认按 CPU 数量')
+    parser.add_argument('--base-url', default=player_cache.client.base_url, help='查分器 API 地址')
+    parser.add_argument('--id-type', choices=('auto', 'qq', 'username'), default='auto',
+                        help='auto 时纯数字视为 qq 号')
+    parser.add_argument('--encoding', help='图片编码，如 png:6、webp:80、jpeg:90')
+    parser.add_argument('--no-render-cache', action='store_true',
+                        help='不使用渲染结果缓存，每个玩家都重新绘制（测吞吐量时使用）')
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error('--concurrency 至少为 1')
+    return asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""BestList 微基准：对比原先每次 push 都排序的实现与现在的实现，并确认两者得到的顺序完全一致。
+
+在项目根目录运行：python benchmarks/bench_best_list.py [记录数]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.libraries.maimai_best_40 import BestList, ChartInfo  # noqa: E402
+
+
+class SortedBestList(object):
+    """原先的实现"""
+
+    def __init__(self, size: int):
+        self.data = []
+        self.size = size
+
+    def push(self, elem: ChartInfo):
+        if len(self.data) >= self.size and elem < self.data[-1]:
+            return
+        self.data.append(elem)
+        self.data.sort()
+        self.data.reverse()
+        while len(self.data) > self.size:
+            del self.data[-1]
+
+
+def make_charts(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    # ra 的取值范围较小，同分很多，和真实玩家的数据相近
+    return [ChartInfo(str(i), rng.randrange(5), 'SD', rng.uniform(80, 101), rng.randint(60, 200),
+                      rng.randrange(5), rng.randrange(14), f'song {i}', 12.0, '12') for i in range(n)]
+
+
+def bench(cls, charts, size: int, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lst = cls(size)
+        for c in charts:
+            lst.push(c)
+        lst.data
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    for order in ('random', 'ascending'):
+        charts = make_charts(n)
+        if order == 'ascending':
+            # 按 ra 升序加入是原实现的最坏情况：几乎每条记录都会触发一次排序
+            charts.sort(key=lambda c: c.ra)
+        for size in (25, 15):
+            old, new = SortedBestList(size), BestList(size)
+            for c in charts:
+                old.push(c)
+                new.push(c)
+            assert [id(c) for c in old.data] == [id(c) for c in new.data]
+            t_old = bench(SortedBestList, charts, size, 5)
+            t_new = bench(BestList, charts, size, 5)
+            print(f'{order:>9} n={n} size={size}: sort per push {t_old * 1000:8.2f} ms, '
+                  f'BestList {t_new * 1000:8.2f} ms ({t_old / t_new:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
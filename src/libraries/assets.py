@@ -0,0 +1,91 @@
+import hashlib
+import os
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from PIL import Image, ImageFont
+
+PicKey = Tuple[str, Optional[str], Optional[float], Optional[Tuple[int, int]]]
+FontKey = Tuple[str, int, str]
+
+
+class AssetRegistry(object):
+    """渲染用静态素材注册表：图片解码、转换、缩放并拆出透明通道后只保留一份，字体按 (路径, 字号, 编码) 缓存。
+    返回的图片是共享的只读对象，需要在上面绘制时先 copy()"""
+
+    def __init__(self, pic_dir: str = 'src/static/mai/pic/'):
+        self.pic_dir = pic_dir
+        self._pics: Dict[PicKey, Tuple[Image.Image, Optional[Image.Image]]] = {}
+        self._signature: Optional[Tuple] = None
+        self._version = ''
+        self._lock = threading.Lock()
+        # FreeType 字体对象不能跨线程同时使用，每个线程各持有一份
+        self._local = threading.local()
+
+    def _load(self, key: PicKey) -> Tuple[Image.Image, Optional[Image.Image]]:
+        name, mode, scale, size = key
+        if scale is None and size is None:
+            img = Image.open(os.path.join(self.pic_dir, name))
+            if mode:
+                img = img.convert(mode)
+            img.load()
+        else:
+            img = self._get((name, mode, None, None))[0]
+            if size is None:
+                size = (int(img.size[0] * scale), int(img.size[1] * scale))
+            img = img.resize(size)
+        alpha = img.getchannel('A') if 'A' in img.getbands() else None
+        return img, alpha
+
+    def _get(self, key: PicKey) -> Tuple[Image.Image, Optional[Image.Image]]:
+        entry = self._pics.get(key)
+        if entry is None:
+            entry = self._load(key)
+            with self._lock:
+                entry = self._pics.setdefault(key, entry)
+        return entry
+
+    def version(self) -> str:
+        """素材版本：pic_dir 中文件名、修改时间与大小的摘要，发生变化时丢弃已解码的图片"""
+        signature = tuple(sorted((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                                 for entry in os.scandir(self.pic_dir) if entry.is_file()))
+        with self._lock:
+            if signature != self._signature:
+                if self._signature is not None:
+                    self._pics.clear()
+                self._signature = signature
+                self._version = hashlib.md5(repr(signature).encode()).hexdigest()[:16]
+            return self._version
+
+    def pic(self, name: str, mode: Optional[str] = 'RGBA', scale: Optional[float] = None,
+            size: Optional[Tuple[int, int]] = None) -> Image.Image:
+        """pic_dir 下的图片，scale 与 _resizePic 的取整方式一致，size 为固定尺寸"""
+        return self._get((name, mode, scale, size))[0]
+
+    def mask(self, name: str, mode: Optional[str] = 'RGBA', scale: Optional[float] = None,
+             size: Optional[Tuple[int, int]] = None) -> Optional[Image.Image]:
+        """与 pic 参数相同的图片的透明通道，用作 paste 的 mask"""
+        return self._get((name, mode, scale, size))[1]
+
+    def font(self, path: str, size: int, encoding: str = '') -> ImageFont.FreeTypeFont:
+        fonts: Dict[FontKey, ImageFont.FreeTypeFont] = getattr(self._local, 'fonts', None)
+        if fonts is None:
+            fonts = self._local.fonts = {}
+        key = (path, size, encoding)
+        font = fonts.get(key)
+        if font is None:
+            font = fonts[key] = ImageFont.truetype(path, size, encoding=encoding)
+        return font
+
+    def preload(self, pics: Iterable[Tuple] = (), fonts: Iterable[FontKey] = ()):
+        """解码 pic_dir 下的所有图片，并加载给出的缩放版本与字体"""
+        for name in sorted(os.listdir(self.pic_dir)):
+            if name.lower().endswith('.png'):
+                self.pic(name)
+        for args in pics:
+            self.pic(*args)
+        for args in fonts:
+            self.font(*args)
+
+
+assets = AssetRegistry()
@@ -0,0 +1,95 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+from PIL import Image, ImageFilter
+
+Stamp = Tuple[int, int]
+
+
+class CoverTileCache(object):
+    """b40 每一格的封面底图缓存：缩放、裁剪、模糊、压暗后的结果按封面缓存在内存中（LRU），可选同时写入磁盘，
+    封面文件被替换后会自动重新生成"""
+
+    def __init__(self, cover_dir: str = 'src/static/mai/cover/', cache_dir: Optional[str] = None,
+                 maxsize: int = 512, width: int = 164, height: int = 88):
+        self.cover_dir = cover_dir
+        self.cache_dir = cache_dir
+        self.maxsize = maxsize
+        self.width = width
+        self.height = height
+        self._tiles: OrderedDict[Tuple[str, str], Tuple[Stamp, Image.Image]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _source(self, cover_id: str) -> str:
+        path = os.path.join(self.cover_dir, f'{cover_id}.png')
+        if not os.path.exists(path):
+            path = os.path.join(self.cover_dir, '1000.png')
+        return path
+
+    def _render(self, path: str, radius: int, darken: bool) -> Image.Image:
+        temp = Image.open(path).convert('RGB')
+        temp = temp.resize((self.width, int(temp.size[1] * self.width / temp.size[0])))
+        temp = temp.crop((0, int((temp.size[1] - self.height) / 2), self.width, int((temp.size[1] + self.height) / 2)))
+        temp = temp.filter(ImageFilter.GaussianBlur(radius))
+        if darken:
+            temp = temp.point(lambda p: int(p * 0.72))
+        return temp
+
+    def _get(self, kind: str, path: str, radius: int, darken: bool) -> Image.Image:
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        key = (kind, path)
+        with self._lock:
+            entry = self._tiles.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._tiles.move_to_end(key)
+                return entry[1].copy()
+        disk_path = None
+        tile = None
+        if self.cache_dir:
+            name = os.path.splitext(os.path.basename(path))[0]
+            disk_path = os.path.join(self.cache_dir, f'{kind}_{name}_{stamp[0]}_{stamp[1]}.png')
+            if os.path.exists(disk_path):
+                tile = Image.open(disk_path)
+                tile.load()
+        if tile is None:
+            tile = self._render(path, radius, darken)
+            if disk_path:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = f'{disk_path}.{os.getpid()}.tmp'
+                tile.save(tmp_path, 'PNG')
+                os.replace(tmp_path, disk_path)
+        with self._lock:
+            self._tiles[key] = (stamp, tile)
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.maxsize:
+                self._tiles.popitem(last=False)
+        return tile.copy()
+
+    @staticmethod
+    def _stamp(path: str) -> Optional[Stamp]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def version(self, cover_ids: Iterable[str] = ()) -> Tuple:
+        """封面的版本：目录的修改时间（增删文件时改变）加上给定封面与 1000.png 各自的 (mtime, 大小)，
+        原地覆盖某张封面时目录的修改时间不变，只能靠后者发现"""
+        paths = sorted({self._source(cover_id) for cover_id in cover_ids})
+        paths.append(os.path.join(self.cover_dir, '1000.png'))
+        return self._stamp(self.cover_dir), tuple((path, self._stamp(path)) for path in paths)
+
+    def tile(self, cover_id: str) -> Image.Image:
+        """有成绩的格子使用的底图（模糊半径 3 并压暗），返回副本，可以直接在上面绘制"""
+        return self._get('tile', self._source(cover_id), 3, True)
+
+    def placeholder(self) -> Image.Image:
+        """空格子使用的底图（1000.png，模糊半径 1）"""
+        return self._get('blank', os.path.join(self.cover_dir, '1000.png'), 1, False)
+
+
+cover_cache = CoverTileCache()
@@ -1,7 +1,12 @@
 import base64
+import binascii
+import time
 from io import BytesIO
+from typing import Dict, Optional, Union
 
-from PIL import ImageFont, ImageDraw, Image
+from PIL import ImageDraw, Image
+
+from src.libraries.assets import assets
 
 
 path = 'src/static/high_eq_image.png'
@@ -10,11 +15,11 @@ fontpath = "src/static/Harmony.ttf"
 
 def draw_text(img_pil, text, offset_x):
     draw = ImageDraw.Draw(img_pil)
-    font = ImageFont.truetype(fontpath, 48)
+    font = assets.font(fontpath, 48)
     width, height = draw.textsize(text, font)
     x = 5
     if width > 390:
-        font = ImageFont.truetype(fontpath, int(390 * 48 / width))
+        font = assets.font(fontpath, int(390 * 48 / width))
         width, height = draw.textsize(text, font)
     else:
         x = int((400 - width) / 2)
@@ -23,7 +28,7 @@ def draw_text(img_pil, text, offset_x):
 
 
 def text_to_image(text):
-    font = ImageFont.truetype(fontpath, 25)
+    font = assets.font(fontpath, 25)
     padding = 10
     margin = 4
     text_list = text.split('\n')
@@ -47,3 +52,112 @@ def image_to_base64(img, format='PNG'):
     byte_data = output_buffer.getvalue()
     base64_str = base64.b64encode(byte_data)
     return base64_str
+
+
+_BASE64_CHUNK = 3 * 16384  # 3 的倍数，分块编码结果可以直接拼接
+
+
+class EncodedImage(object):
+    """编码后的图片数据与本次编码的大小、耗时；data 可以是 bytes 或直接引用编码缓冲区的 memoryview"""
+
+    def __init__(self, data: Union[bytes, memoryview], format: str, seconds: float):
+        self.data = data
+        self.format = format
+        self.seconds = seconds
+
+    def __reduce__(self):
+        # 从渲染进程传回时 memoryview 不能直接序列化
+        return EncodedImage, (bytes(self.data), self.format, self.seconds)
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def _base64(self, prefix: bytes) -> str:
+        # 分块写进预先分配好的缓冲区，只有最终的字符串是整张图大小的拷贝
+        data = memoryview(self.data).cast('B')
+        out = bytearray(len(prefix) + (len(data) + 2) // 3 * 4)
+        out[:len(prefix)] = prefix
+        pos = len(prefix)
+        for i in range(0, len(data), _BASE64_CHUNK):
+            chunk = binascii.b2a_base64(data[i:i + _BASE64_CHUNK], newline=False)
+            out[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+        return out.decode('ascii')
+
+    def to_base64(self) -> str:
+        return self._base64(b'')
+
+    def to_file(self) -> str:
+        """OneBot 图片消息的 file 字段"""
+        return self._base64(b'base64://')
+
+    def __str__(self):
+        return f'{self.format} {self.size / 1024:.1f} KiB in {self.seconds * 1000:.1f} ms'
+
+
+class ImageEncoder(object):
+    """输出图片的编码方式：PNG 可调压缩级别，WebP / JPEG 可调质量"""
+
+    def __init__(self, format: str = 'PNG', quality: Optional[int] = None, compress_level: Optional[int] = None,
+                 lossless: bool = False):
+        self.format = format.upper()
+        if self.format == 'JPG':
+            self.format = 'JPEG'
+        if self.format not in ('PNG', 'WEBP', 'JPEG'):
+            raise ValueError(f'unsupported image format: {format}')
+        self.quality = quality
+        self.compress_level = compress_level
+        self.lossless = lossless
+
+    @classmethod
+    def from_config(cls, value: str) -> 'ImageEncoder':
+        """解析 "png"、"png:3"（压缩级别）、"webp:80"、"webp:lossless"、"jpeg:90"（质量）这样的配置"""
+        format, _, arg = value.partition(':')
+        if not arg:
+            return cls(format)
+        if format.upper() == 'PNG':
+            return cls(format, compress_level=int(arg))
+        if arg == 'lossless':
+            return cls(format, lossless=True)
+        return cls(format, quality=int(arg))
+
+    def _save_options(self) -> Dict:
+        if self.format == 'PNG':
+            return {} if self.compress_level is None else {'compress_level': self.compress_level}
+        options = {'quality': 85 if self.quality is None else self.quality}
+        if self.format == 'WEBP':
+            options['lossless'] = self.lossless
+            options['method'] = 4
+        return options
+
+    def encode(self, img: Image.Image) -> EncodedImage:
+        start = time.perf_counter()
+        if self.format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        elif img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            img = img.convert('RGBA')
+        output_buffer = BytesIO()
+        img.save(output_buffer, self.format, **self._save_options())
+        return EncodedImage(output_buffer.getbuffer(), self.format, time.perf_counter() - start)
+
+    def __repr__(self):
+        return f'ImageEncoder({self.format!r}, quality={self.quality}, compress_level={self.compress_level}, ' \
+               f'lossless={self.lossless})'
+
+
+default_encoder = ImageEncoder()
+image_encoders: Dict[str, ImageEncoder] = {}
+
+
+def configure_encoders(config: Dict[str, str]):
+    """按命令设置编码方式，例如 {"b40": "webp:90", "help": "png:1"}，键 default 为未配置命令的默认值"""
+    global default_encoder
+    encoders = {command: ImageEncoder.from_config(value) for command, value in config.items()}
+    default_encoder = encoders.pop('default', default_encoder)
+    image_encoders.clear()
+    image_encoders.update(encoders)
+
+
+def encoder_for(command: str) -> ImageEncoder:
+    return image_encoders.get(command, default_encoder)
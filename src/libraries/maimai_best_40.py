@@ -1,15 +1,21 @@
-import base64
-import io
+import bisect
 import math
-import os
-from typing import Optional, Dict, List
+import threading
+from collections import deque
+from typing import Optional, Dict, List, Tuple
 
-import aiohttp
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from matplotlib import pyplot as plt
-
-from src.libraries.maimaidx_music import get_cover_len4_id, total_list
+from PIL import Image, ImageDraw
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from src.libraries.assets import assets
+from src.libraries.cover_cache import cover_cache
+from src.libraries.image import EncodedImage, ImageEncoder, encoder_for
+from src.libraries.maimaidx_music import get_cover_len4_id, get_total_list, _stringQ2B
+from src.libraries.maimaidx_prober import player_cache
+from src.libraries.render_cache import render_cache
+from src.libraries.render_pool import render_pool
 
 scoreRank = 'D C B BB BBB A AA AAA S S+ SS SS+ SSS SSS+'.split(' ')
 combo = ' FC FC+ AP AP+'.split(' ')
@@ -46,7 +52,7 @@ class ChartInfo(object):
         fc = ['', 'fc', 'fcp', 'ap', 'app']
         fi = fc.index(data["fc"])
         return cls(
-            idNum=total_list.by_title(data["title"]).id,
+            idNum=get_total_list().by_title(data["title"]).id,
             title=data["title"],
             diff=data["level_index"],
             ra=data["ra"],
@@ -60,50 +66,89 @@ class ChartInfo(object):
 
 
 class BestList(object):
+    """按 ra 从高到低保留前 size 个成绩。
+    以前每次 push 都会追加、稳定排序再整体反转，同分成绩的先后顺序因此在每次加入新成绩后翻转一次；
+    这里按 ra 分组保存在 deque 中，用一个全局的翻转标记记录当前方向，push 的开销与已有成绩数量无关，
+    得到的顺序与原来完全一致"""
 
     def __init__(self, size: int):
-        self.data = []
         self.size = size
+        self._groups: Dict[int, deque] = {}
+        self._ras: List[int] = []  # 升序排列的不同 ra
+        self._flipped = False  # 为 True 时每组的实际顺序是 deque 的逆序
+        self._len = 0
+        self._data: Optional[List[ChartInfo]] = None
+
+    @classmethod
+    def from_records(cls, charts: Dict[str, List[Dict]], sd_size: int = 25,
+                     dx_size: int = 15) -> Tuple['BestList', 'BestList']:
+        """由查分器返回的 charts 一次构造 (sd_best, dx_best)，进不了前 size 的记录不会被解析"""
+        lists = []
+        for records, size in ((charts["sd"], sd_size), (charts["dx"], dx_size)):
+            best = cls(size)
+            for c in records:
+                if best.accepts(c["ra"]):
+                    best.push(ChartInfo.from_json(c))
+            lists.append(best)
+        return lists[0], lists[1]
+
+    def accepts(self, ra: int) -> bool:
+        return self._len < self.size or ra >= self._ras[0]
 
     def push(self, elem: ChartInfo):
-        if len(self.data) >= self.size and elem < self.data[-1]:
+        if not self.accepts(elem.ra):
             return
-        self.data.append(elem)
-        self.data.sort()
-        self.data.reverse()
-        while len(self.data) > self.size:
-            del self.data[-1]
+        # 原实现中加入新成绩会让所有同分组反向，新成绩排在自己所在组的最前面
+        self._flipped = not self._flipped
+        group = self._groups.get(elem.ra)
+        if group is None:
+            group = self._groups[elem.ra] = deque()
+            bisect.insort(self._ras, elem.ra)
+        if self._flipped:
+            group.append(elem)
+        else:
+            group.appendleft(elem)
+        self._len += 1
+        while self._len > self.size:
+            self._popLast()
+        self._data = None
+
+    def _popLast(self):
+        ra = self._ras[0]
+        group = self._groups[ra]
+        if self._flipped:
+            group.popleft()
+        else:
+            group.pop()
+        if not group:
+            del self._groups[ra]
+            del self._ras[0]
+        self._len -= 1
 
     def pop(self):
-        del self.data[-1]
+        self._popLast()
+        self._data = None
+
+    @property
+    def data(self) -> List[ChartInfo]:
+        if self._data is None:
+            data = []
+            for ra in reversed(self._ras):
+                group = self._groups[ra]
+                data.extend(reversed(group) if self._flipped else group)
+            self._data = data
+        return self._data
 
     def __str__(self):
         return '[\n\t' + ', \n\t'.join([str(ci) for ci in self.data]) + '\n]'
 
     def __len__(self):
-        return len(self.data)
+        return self._len
 
     def __getitem__(self, index):
         return self.data[index]
 
 
-def _Q2B(uchar):
-    """单个字符 全角转半角"""
-    inside_code = ord(uchar)
-    if inside_code == 0x3000:
-        inside_code = 0x0020
-    else:
-        inside_code -= 0xfee0
-    if inside_code < 0x0020 or inside_code > 0x7e:  # 转完之后不是半角字符返回原来的字符
-        return uchar
-    return chr(inside_code)
-
-
-def _stringQ2B(ustring):
-    """把字符串全角转半角"""
-    return "".join([_Q2B(uchar) for uchar in ustring])
-
-
 def _getCharWidth(o) -> int:
     widths = [
         (126, 1), (159, 0), (687, 1), (710, 0), (711, 1), (727, 0), (733, 1), (879, 0), (1154, 1), (1161, 0),
@@ -141,6 +186,95 @@ def _resizePic(img: Image.Image, time: float):
     return img.resize((int(img.size[0] * time), int(img.size[1] * time)))
 
 
+def preload_assets():
+    """加载 b40 与 sb40 用到的全部素材、缩放版本和字体"""
+    pics = [(f'UI_GAM_Rank_{rank}.png', 'RGBA', 0.3)
+            for rank in 'D C B BB BBB A AA AAA S Sp SS SSp SSS SSSp'.split(' ')]
+    pics += [(f'UI_MSS_MBase_Icon_{combo}_S.png', 'RGBA', 0.45) for combo in 'FC FCp AP APp'.split(' ')]
+    pics += [(f'UI_NUM_Drating_{digit}.png', 'RGBA', 0.6) for digit in range(10)]
+    pics += [('UI_CMN_TabTitle_MaimaiTitle_Ver214.png', 'RGBA', 0.65), ('UI_CMN_Name_DX.png', 'RGBA', 0.9),
+             ('UI_CMN_MiniDialog_01.png', 'RGBA', 0.35), ('UI_TST_PlateMask.png', 'RGBA', None, (285, 40)),
+             ('white.png', None)]
+    fonts = [('src/static/adobe_simhei.otf', size, 'utf-8') for size in (12, 14, 16, 18)]
+    fonts += [('src/static/msyh.ttc', 28, 'unic'), ('src/static/Harmony.ttf', 28), ('src/static/Harmony.ttf', 18)]
+    assets.preload(pics, fonts)
+
+
+_ROWS_IMG = [2] + [116 + 96 * i for i in range(6)]
+_COLUMNS_IMG = [2 + 172 * i for i in range(6)] + [888 + 172 * i for i in range(4)]
+Layer = Tuple[Image.Image, Tuple[int, int], Image.Image]
+
+
+def _layerBox(img: Image.Image, pos: Tuple[int, int], mask: Optional[Image.Image] = None) -> Tuple[int, int, int, int]:
+    box = (mask.getbbox() if mask is not None else None) or (0, 0) + img.size
+    return pos[0] + box[0], pos[1] + box[1], pos[0] + box[2], pos[1] + box[3]
+
+
+def _overlaps(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class _B40Template(object):
+    """b40 中与玩家无关的图层（背景、标题、右上角对话框、DX/SD 标记）预先合成好，每次绘制从副本开始；
+    素材目录变化时重新合成"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version: Optional[str] = None
+        self._base: Optional[Image.Image] = None
+        self._late: List[Layer] = []
+
+    def _dynamicBoxes(self) -> List[Tuple[int, int, int, int]]:
+        # 每个玩家都不同的区域：Rating、名牌、称号与 40 个格子
+        boxes = []
+        for num in range(1, 11):
+            ratingBaseImg = assets.pic(f'UI_CMN_DXRating_S_{num:02d}.png')
+            boxes.append(_layerBox(_resizePic(ratingBaseImg, 0.85), (240, 8)))
+        boxes.append(_layerBox(assets.pic('UI_TST_PlateMask.png', size=(285, 40)), (240, 40)))
+        boxes.append(_layerBox(_resizePic(assets.pic('UI_CMN_Shougou_Rainbow.png'), 1.05), (240, 83)))
+        boxes.append((_COLUMNS_IMG[0] + 4, _ROWS_IMG[1] + 4, _COLUMNS_IMG[-1] + 5 + 164, _ROWS_IMG[-1] + 5 + 88))
+        return boxes
+
+    def _build(self):
+        base = assets.pic('UI_TTR_BG_Base_Plus.png').copy()
+        base.paste(assets.pic('UI_CMN_TabTitle_MaimaiTitle_Ver214.png', scale=0.65), (10, 10),
+                   mask=assets.mask('UI_CMN_TabTitle_MaimaiTitle_Ver214.png', scale=0.65))
+
+        authorBoardImg = assets.pic('UI_CMN_MiniDialog_01.png', scale=0.35).copy()
+        authorBoardDraw = ImageDraw.Draw(authorBoardImg)
+        authorBoardDraw.text((31, 28), '   Generated By\nXybBot & Chiyuki', 'black',
+                             assets.font('src/static/adobe_simhei.otf', 14, 'utf-8'))
+        layers: List[Layer] = [
+            (authorBoardImg, (1224, 19), authorBoardImg.getchannel('A')),
+            (assets.pic('UI_RSL_MBase_Parts_01.png'), (890, 65), assets.mask('UI_RSL_MBase_Parts_01.png')),
+            (assets.pic('UI_RSL_MBase_Parts_02.png'), (758, 65), assets.mask('UI_RSL_MBase_Parts_02.png')),
+        ]
+        # 这些图层原本在格子之后绘制，与玩家相关的区域（或之前留到最后绘制的图层）有重叠时保持原来的顺序逐次绘制
+        boxes = self._dynamicBoxes()
+        late: List[Layer] = []
+        for layer in layers:
+            box = _layerBox(*layer)
+            if any(_overlaps(box, other) for other in boxes):
+                late.append(layer)
+                boxes.append(box)
+            else:
+                base.paste(*layer)
+        self._base = base
+        self._late = late
+
+    def get(self) -> Tuple[Image.Image, List[Layer]]:
+        """返回 (背景副本, 仍需在格子之后绘制的图层)"""
+        version = assets.version()
+        with self._lock:
+            if version != self._version:
+                self._build()
+                self._version = version
+            return self._base.copy(), self._late
+
+
+b40_template = _B40Template()
+
+
 class DrawBest(object):
 
     def __init__(self, sdBest: BestList, dxBest: BestList, userName: str, playerRating: int, musicRating: int):
@@ -150,17 +284,9 @@ class DrawBest(object):
         self.playerRating = playerRating
         self.musicRating = musicRating
         self.rankRating = self.playerRating - self.musicRating
-        self.pic_dir = 'src/static/mai/pic/'
-        self.cover_dir = 'src/static/mai/cover/'
-        self.img = Image.open(self.pic_dir + 'UI_TTR_BG_Base_Plus.png').convert('RGBA')
-        self.ROWS_IMG = [2]
-        for i in range(6):
-            self.ROWS_IMG.append(116 + 96 * i)
-        self.COLUMNS_IMG = []
-        for i in range(6):
-            self.COLUMNS_IMG.append(2 + 172 * i)
-        for i in range(4):
-            self.COLUMNS_IMG.append(888 + 172 * i)
+        self.img, self.lateLayers = b40_template.get()
+        self.ROWS_IMG = _ROWS_IMG
+        self.COLUMNS_IMG = _COLUMNS_IMG
         self.draw()
 
     def _findRaPic(self) -> str:
@@ -192,9 +318,9 @@ class DrawBest(object):
         while theRa:
             digit = theRa % 10
             theRa = theRa // 10
-            digitImg = Image.open(self.pic_dir + f'UI_NUM_Drating_{digit}.png').convert('RGBA')
-            digitImg = _resizePic(digitImg, 0.6)
-            ratingBaseImg.paste(digitImg, (COLUMNS_RATING[i] - 2, 9), mask=digitImg.split()[3])
+            digitName = f'UI_NUM_Drating_{digit}.png'
+            ratingBaseImg.paste(assets.pic(digitName, scale=0.6), (COLUMNS_RATING[i] - 2, 9),
+                                mask=assets.mask(digitName, scale=0.6))
             i = i - 1
         return ratingBaseImg
 
@@ -205,128 +331,90 @@ class DrawBest(object):
         levelTriagle = [(itemW, 0), (itemW - 27, 0), (itemW, 27)]
         rankPic = 'D C B BB BBB A AA AAA S Sp SS SSp SSS SSSp'.split(' ')
         comboPic = ' FC FCp AP APp'.split(' ')
+        recBase = Image.new('RGBA', (itemW, itemH), 'black')
+        recBase = recBase.point(lambda p: int(p * 0.8))
         ImageDraw.Draw(img)
         titleFontName = 'src/static/adobe_simhei.otf'
+        titleFont = assets.font(titleFontName, 16, 'utf-8')
+        achievementFont = assets.font(titleFontName, 14, 'utf-8')
+        baseFont = assets.font(titleFontName, 12, 'utf-8')
+        rankFont = assets.font(titleFontName, 18, 'utf-8')
         for num in range(0, len(sdBest)):
             i = num // 5
             j = num % 5
             chartInfo = sdBest[num]
-            pngPath = self.cover_dir + f'{get_cover_len4_id(chartInfo.idNum)}.png'
-            if not os.path.exists(pngPath):
-                pngPath = self.cover_dir + '1000.png'
-            temp = Image.open(pngPath).convert('RGB')
-            temp = _resizePic(temp, itemW / temp.size[0])
-            temp = temp.crop((0, int((temp.size[1] - itemH) / 2), itemW, int((temp.size[1] + itemH) / 2)))
-            temp = temp.filter(ImageFilter.GaussianBlur(3))
-            temp = temp.point(lambda p: int(p * 0.72))
+            temp = cover_cache.tile(get_cover_len4_id(chartInfo.idNum))
 
             tempDraw = ImageDraw.Draw(temp)
             tempDraw.polygon(levelTriagle, Color[chartInfo.diff])
-            font = ImageFont.truetype(titleFontName, 16, encoding='utf-8')
             title = chartInfo.title
             if _columnWidth(title) > 15:
                 title = _changeColumnWidth(title, 14) + '...'
-            tempDraw.text((8, 8), title, 'white', font)
-            font = ImageFont.truetype(titleFontName, 14, encoding='utf-8')
+            tempDraw.text((8, 8), title, 'white', titleFont)
 
-            tempDraw.text((7, 28), f'{"%.4f" % chartInfo.achievement}%', 'white', font)
-            rankImg = Image.open(self.pic_dir + f'UI_GAM_Rank_{rankPic[chartInfo.scoreId]}.png').convert('RGBA')
-            rankImg = _resizePic(rankImg, 0.3)
-            temp.paste(rankImg, (88, 28), rankImg.split()[3])
+            tempDraw.text((7, 28), f'{"%.4f" % chartInfo.achievement}%', 'white', achievementFont)
+            rankName = f'UI_GAM_Rank_{rankPic[chartInfo.scoreId]}.png'
+            temp.paste(assets.pic(rankName, scale=0.3), (88, 28), assets.mask(rankName, scale=0.3))
             if chartInfo.comboId:
-                comboImg = Image.open(self.pic_dir + f'UI_MSS_MBase_Icon_{comboPic[chartInfo.comboId]}_S.png').convert(
-                    'RGBA')
-                comboImg = _resizePic(comboImg, 0.45)
-                temp.paste(comboImg, (119, 27), comboImg.split()[3])
-            font = ImageFont.truetype('src/static/adobe_simhei.otf', 12, encoding='utf-8')
-            tempDraw.text((8, 44), f'Base: {chartInfo.ds} -> {chartInfo.ra}', 'white', font)
-            font = ImageFont.truetype('src/static/adobe_simhei.otf', 18, encoding='utf-8')
-            tempDraw.text((8, 60), f'#{num + 1}', 'white', font)
-
-            recBase = Image.new('RGBA', (itemW, itemH), 'black')
-            recBase = recBase.point(lambda p: int(p * 0.8))
+                comboName = f'UI_MSS_MBase_Icon_{comboPic[chartInfo.comboId]}_S.png'
+                temp.paste(assets.pic(comboName, scale=0.45), (119, 27), assets.mask(comboName, scale=0.45))
+            tempDraw.text((8, 44), f'Base: {chartInfo.ds} -> {chartInfo.ra}', 'white', baseFont)
+            tempDraw.text((8, 60), f'#{num + 1}', 'white', rankFont)
+
             img.paste(recBase, (self.COLUMNS_IMG[j] + 5, self.ROWS_IMG[i + 1] + 5))
             img.paste(temp, (self.COLUMNS_IMG[j] + 4, self.ROWS_IMG[i + 1] + 4))
         for num in range(len(sdBest), sdBest.size):
             i = num // 5
             j = num % 5
-            temp = Image.open(self.cover_dir + f'1000.png').convert('RGB')
-            temp = _resizePic(temp, itemW / temp.size[0])
-            temp = temp.crop((0, int((temp.size[1] - itemH) / 2), itemW, int((temp.size[1] + itemH) / 2)))
-            temp = temp.filter(ImageFilter.GaussianBlur(1))
+            temp = cover_cache.placeholder()
             img.paste(temp, (self.COLUMNS_IMG[j] + 4, self.ROWS_IMG[i + 1] + 4))
         for num in range(0, len(dxBest)):
             i = num // 3
             j = num % 3
             chartInfo = dxBest[num]
-            pngPath = self.cover_dir + f'{get_cover_len4_id(chartInfo.idNum)}.png'
-            if not os.path.exists(pngPath):
-                pngPath = self.cover_dir + '1000.png'
-            temp = Image.open(pngPath).convert('RGB')
-            temp = _resizePic(temp, itemW / temp.size[0])
-            temp = temp.crop((0, int((temp.size[1] - itemH) / 2), itemW, int((temp.size[1] + itemH) / 2)))
-            temp = temp.filter(ImageFilter.GaussianBlur(3))
-            temp = temp.point(lambda p: int(p * 0.72))
+            temp = cover_cache.tile(get_cover_len4_id(chartInfo.idNum))
 
             tempDraw = ImageDraw.Draw(temp)
             tempDraw.polygon(levelTriagle, Color[chartInfo.diff])
-            font = ImageFont.truetype(titleFontName, 16, encoding='utf-8')
             title = chartInfo.title
             if _columnWidth(title) > 15:
                 title = _changeColumnWidth(title, 14) + '...'
-            tempDraw.text((8, 8), title, 'white', font)
-            font = ImageFont.truetype(titleFontName, 14, encoding='utf-8')
+            tempDraw.text((8, 8), title, 'white', titleFont)
 
-            tempDraw.text((7, 28), f'{"%.4f" % chartInfo.achievement}%', 'white', font)
-            rankImg = Image.open(self.pic_dir + f'UI_GAM_Rank_{rankPic[chartInfo.scoreId]}.png').convert('RGBA')
-            rankImg = _resizePic(rankImg, 0.3)
-            temp.paste(rankImg, (88, 28), rankImg.split()[3])
+            tempDraw.text((7, 28), f'{"%.4f" % chartInfo.achievement}%', 'white', achievementFont)
+            rankName = f'UI_GAM_Rank_{rankPic[chartInfo.scoreId]}.png'
+            temp.paste(assets.pic(rankName, scale=0.3), (88, 28), assets.mask(rankName, scale=0.3))
             if chartInfo.comboId:
-                comboImg = Image.open(self.pic_dir + f'UI_MSS_MBase_Icon_{comboPic[chartInfo.comboId]}_S.png').convert(
-                    'RGBA')
-                comboImg = _resizePic(comboImg, 0.45)
-                temp.paste(comboImg, (119, 27), comboImg.split()[3])
-            font = ImageFont.truetype('src/static/adobe_simhei.otf', 12, encoding='utf-8')
-            tempDraw.text((8, 44), f'Base: {chartInfo.ds} -> {chartInfo.ra}', 'white', font)
-            font = ImageFont.truetype('src/static/adobe_simhei.otf', 18, encoding='utf-8')
-            tempDraw.text((8, 60), f'#{num + 1}', 'white', font)
-
-            recBase = Image.new('RGBA', (itemW, itemH), 'black')
-            recBase = recBase.point(lambda p: int(p * 0.8))
+                comboName = f'UI_MSS_MBase_Icon_{comboPic[chartInfo.comboId]}_S.png'
+                temp.paste(assets.pic(comboName, scale=0.45), (119, 27), assets.mask(comboName, scale=0.45))
+            tempDraw.text((8, 44), f'Base: {chartInfo.ds} -> {chartInfo.ra}', 'white', baseFont)
+            tempDraw.text((8, 60), f'#{num + 1}', 'white', rankFont)
+
             img.paste(recBase, (self.COLUMNS_IMG[j + 6] + 5, self.ROWS_IMG[i + 1] + 5))
             img.paste(temp, (self.COLUMNS_IMG[j + 6] + 4, self.ROWS_IMG[i + 1] + 4))
         for num in range(len(dxBest), dxBest.size):
             i = num // 3
             j = num % 3
-            temp = Image.open(self.cover_dir + f'1000.png').convert('RGB')
-            temp = _resizePic(temp, itemW / temp.size[0])
-            temp = temp.crop((0, int((temp.size[1] - itemH) / 2), itemW, int((temp.size[1] + itemH) / 2)))
-            temp = temp.filter(ImageFilter.GaussianBlur(1))
+            temp = cover_cache.placeholder()
             img.paste(temp, (self.COLUMNS_IMG[j + 6] + 4, self.ROWS_IMG[i + 1] + 4))
 
     def draw(self):
-        splashLogo = Image.open(self.pic_dir + 'UI_CMN_TabTitle_MaimaiTitle_Ver214.png').convert('RGBA')
-        splashLogo = _resizePic(splashLogo, 0.65)
-        self.img.paste(splashLogo, (10, 10), mask=splashLogo.split()[3])
-
-        ratingBaseImg = Image.open(self.pic_dir + self._findRaPic()).convert('RGBA')
+        ratingBaseImg = assets.pic(self._findRaPic()).copy()
         ratingBaseImg = self._drawRating(ratingBaseImg)
         ratingBaseImg = _resizePic(ratingBaseImg, 0.85)
         self.img.paste(ratingBaseImg, (240, 8), mask=ratingBaseImg.split()[3])
 
-        namePlateImg = Image.open(self.pic_dir + 'UI_TST_PlateMask.png').convert('RGBA')
-        namePlateImg = namePlateImg.resize((285, 40))
+        namePlateImg = assets.pic('UI_TST_PlateMask.png', size=(285, 40)).copy()
         namePlateDraw = ImageDraw.Draw(namePlateImg)
-        font1 = ImageFont.truetype('src/static/msyh.ttc', 28, encoding='unic')
+        font1 = assets.font('src/static/msyh.ttc', 28, 'unic')
         namePlateDraw.text((12, 4), ' '.join(list(self.userName)), 'black', font1)
-        nameDxImg = Image.open(self.pic_dir + 'UI_CMN_Name_DX.png').convert('RGBA')
-        nameDxImg = _resizePic(nameDxImg, 0.9)
-        namePlateImg.paste(nameDxImg, (230, 4), mask=nameDxImg.split()[3])
+        namePlateImg.paste(assets.pic('UI_CMN_Name_DX.png', scale=0.9), (230, 4),
+                           mask=assets.mask('UI_CMN_Name_DX.png', scale=0.9))
         self.img.paste(namePlateImg, (240, 40), mask=namePlateImg.split()[3])
 
-        shougouImg = Image.open(self.pic_dir + 'UI_CMN_Shougou_Rainbow.png').convert('RGBA')
+        shougouImg = assets.pic('UI_CMN_Shougou_Rainbow.png').copy()
         shougouDraw = ImageDraw.Draw(shougouImg)
-        font2 = ImageFont.truetype('src/static/adobe_simhei.otf', 14, encoding='utf-8')
+        font2 = assets.font('src/static/adobe_simhei.otf', 14, 'utf-8')
         playCountInfo = f'底分: {self.musicRating} + 段位分: {self.rankRating}'
         shougouImgW, shougouImgH = shougouImg.size
         playCountInfoW, playCountInfoH = shougouDraw.textsize(playCountInfo, font2)
@@ -345,16 +433,8 @@ class DrawBest(object):
 
         self._drawBestList(self.img, self.sdBest, self.dxBest)
 
-        authorBoardImg = Image.open(self.pic_dir + 'UI_CMN_MiniDialog_01.png').convert('RGBA')
-        authorBoardImg = _resizePic(authorBoardImg, 0.35)
-        authorBoardDraw = ImageDraw.Draw(authorBoardImg)
-        authorBoardDraw.text((31, 28), '   Generated By\nXybBot & Chiyuki', 'black', font2)
-        self.img.paste(authorBoardImg, (1224, 19), mask=authorBoardImg.split()[3])
-
-        dxImg = Image.open(self.pic_dir + 'UI_RSL_MBase_Parts_01.png').convert('RGBA')
-        self.img.paste(dxImg, (890, 65), mask=dxImg.split()[3])
-        sdImg = Image.open(self.pic_dir + 'UI_RSL_MBase_Parts_02.png').convert('RGBA')
-        self.img.paste(sdImg, (758, 65), mask=sdImg.split()[3])
+        for layer in self.lateLayers:
+            self.img.paste(*layer)
 
     def getDir(self):
         return self.img
@@ -392,37 +472,72 @@ def computeRa(ds: float, achievement: float) -> int:
     return math.floor(ds * (min(100.5, achievement) / 100) * baseRa)
 
 
-async def generate(payload: Dict) -> (Optional[Image.Image], bool):
-    async with aiohttp.request("POST", "https://www.diving-fish.com/api/maimaidxprober/query/player",
-                               json=payload) as resp:
-        if resp.status == 400:
-            return None, 400
-        if resp.status == 403:
-            return None, 403
-        sd_best = BestList(25)
-        dx_best = BestList(15)
-        obj = await resp.json()
-        dx: List[Dict] = obj["charts"]["dx"]
-        sd: List[Dict] = obj["charts"]["sd"]
-        for c in sd:
-            sd_best.push(ChartInfo.from_json(c))
-        for c in dx:
-            dx_best.push(ChartInfo.from_json(c))
-        pic = DrawBest(sd_best, dx_best, obj["nickname"], obj["rating"] + obj["additional_rating"],
-                       obj["rating"]).getDir()
-        return pic, 0
+class PlayerBest(object):
+    """流式解析 /query/player 得到的玩家信息（charts 为空）与 b40，解析过程中只保留进入前 25 / 15 的成绩"""
+
+    def __init__(self, sd_size: int = 25, dx_size: int = 15):
+        self.info: Dict = {}
+        self.sd_best = BestList(sd_size)
+        self.dx_best = BestList(dx_size)
+
+    def feed(self, kind: str, record: Dict):
+        best = self.sd_best if kind == 'sd' else self.dx_best
+        if best.accepts(record["ra"]):
+            best.push(ChartInfo.from_json(record))
+
+
+async def _load_best(payload: Dict) -> Tuple[int, Optional[PlayerBest]]:
+    best = PlayerBest()
+    status, info = await player_cache.client.query_player_stream(payload, best.feed)
+    if status:
+        return status, None
+    best.info = info
+    return 0, best
+
+
+async def query_best(payload: Dict) -> Tuple[int, Optional[PlayerBest]]:
+    """b40 / sb40 / cal 使用的玩家数据，结果为共享对象，不要修改"""
+    return await player_cache.query('best', payload, _load_best)
+
+
+def _renderKey(kind: str, encoder: ImageEncoder, sd_best: BestList, dx_best: BestList, *extra) -> str:
+    """渲染结果缓存的键：图上出现的全部成绩字段、玩家信息、素材版本与编码方式"""
+    charts = tuple(tuple((c.idNum, c.diff, c.tp, c.achievement, c.ra, c.comboId, c.scoreId, c.title, c.ds, c.lv)
+                         for c in best.data) for best in (sd_best, dx_best))
+    covers = cover_cache.version(get_cover_len4_id(c.idNum) for best in (sd_best, dx_best) for c in best.data)
+    return render_cache.key(kind, repr(encoder), assets.version(), covers, sd_best.size, dx_best.size, charts, extra)
+
+
+def render_best(sd_best: BestList, dx_best: BestList, userName: str, playerRating: int, musicRating: int,
+                encoder: ImageEncoder) -> EncodedImage:
+    return encoder.encode(DrawBest(sd_best, dx_best, userName, playerRating, musicRating).getDir())
+
+
+async def generate(payload: Dict, encoder: Optional[ImageEncoder] = None) -> (Optional[EncodedImage], bool):
+    status, best = await query_best(payload)
+    if status:
+        return None, status
+    obj, sd_best, dx_best = best.info, best.sd_best, best.dx_best
+    encoder = encoder or encoder_for('b40')
+    userName, playerRating, musicRating = obj["nickname"], obj["rating"] + obj["additional_rating"], obj["rating"]
+    key = _renderKey('b40', encoder, sd_best, dx_best, userName, playerRating, musicRating)
+    pic = await render_cache.get(key)
+    if pic is None:
+        pic = await render_pool.run(render_best, sd_best, dx_best, userName, playerRating, musicRating, encoder)
+        await render_cache.put(key, pic)
+    return pic, 0
 
 
 class DrawBestSimple(object):
     def __init__(self, sd_best: BestList, dx_best: BestList):
-        self.image = Image.open('src/static/mai/pic/white.png')
+        self.image = assets.pic('white.png', mode=None).copy()
         self.sd_best = sd_best
         self.dx_best = dx_best
 
     def load(self):
         draw = ImageDraw.Draw(self.image)
-        bigFont = ImageFont.truetype("src/static/Harmony.ttf", 28)
-        smallFont = ImageFont.truetype("src/static/Harmony.ttf", 18)
+        bigFont = assets.font("src/static/Harmony.ttf", 28)
+        smallFont = assets.font("src/static/Harmony.ttf", 18)
         nowTextX = 45
         nowTextY = 50
 
@@ -487,72 +602,99 @@ class DrawBestSimple(object):
         return self.image
 
 
-async def generate_simple(payload: Dict) -> (Optional[Image.Image], bool):
-    async with aiohttp.request("POST", "https://www.diving-fish.com/api/maimaidxprober/query/player",
-                               json=payload) as resp:
-        if resp.status == 400:
-            return None, 400
-        if resp.status == 403:
-            return None, 403
-        sd_best = BestList(25)
-        dx_best = BestList(15)
-        obj = await resp.json()
-
-        dx: List[Dict] = obj["charts"]["dx"]
-        sd: List[Dict] = obj["charts"]["sd"]
-        for c in sd:
-            sd_best.push(ChartInfo.from_json(c))
-        for c in dx:
-            dx_best.push(ChartInfo.from_json(c))
-        tmp = DrawBestSimple(sd_best, dx_best)
-        tmp.load()
-        return tmp.get(), 0
-
-
-async def generate_cal(payload: Dict) -> (str, bool):
-    async with aiohttp.request("POST", "https://www.diving-fish.com/api/maimaidxprober/query/player",
-                               json=payload) as resp:
-        if resp.status == 400:
-            return None, 400
-        if resp.status == 403:
-            return None, 403
-        sd_best = BestList(25)
-        dx_best = BestList(15)
-        obj = await resp.json()
-
-        dx: List[Dict] = obj["charts"]["dx"]
-        sd: List[Dict] = obj["charts"]["sd"]
-        for c in sd:
-            sd_best.push(ChartInfo.from_json(c))
-        for c in dx:
-            dx_best.push(ChartInfo.from_json(c))
-        print(sd_best)
-        X1 = list(np.arange(1, 26))
-        Y1 = []
-        sd_best.data.reverse()
-        dx_best.data.reverse()
-        for i in sd_best.data:
-            i: ChartInfo
-            Y1.append(i.ra)
+def render_best_simple(sd_best: BestList, dx_best: BestList, encoder: ImageEncoder) -> EncodedImage:
+    tmp = DrawBestSimple(sd_best, dx_best)
+    tmp.load()
+    return encoder.encode(tmp.get())
 
-        X2 = list(np.arange(1, 16))
-        Y2 = []
-        for i in dx_best.data:
-            i: ChartInfo
-            Y2.append(i.ra)
-
-        ax1 = plt.subplot(211)
-        ax1.plot(X1, Y1, "ob:")
-        ax1.plot()
-
-        ax2 = plt.subplot(212)
-        ax2.plot(X2, Y2, "or:")
-        ax2.plot()
-
-        my_stringIObytes = io.BytesIO()
-        plt.savefig(my_stringIObytes, format='png')
-        my_stringIObytes.seek(0)
-        my_base64_jpgData = base64.b64encode(my_stringIObytes.read())
-        pngStr = str(my_base64_jpgData, "utf-8")
-        print(pngStr)
-        return pngStr, 0
+
+async def generate_simple(payload: Dict, encoder: Optional[ImageEncoder] = None) -> (Optional[EncodedImage], bool):
+    status, best = await query_best(payload)
+    if status:
+        return None, status
+    sd_best, dx_best = best.sd_best, best.dx_best
+    encoder = encoder or encoder_for('sb40')
+    key = _renderKey('sb40', encoder, sd_best, dx_best)
+    pic = await render_cache.get(key)
+    if pic is None:
+        pic = await render_pool.run(render_best_simple, sd_best, dx_best, encoder)
+        await render_cache.put(key, pic)
+    return pic, 0
+
+
+_calLocal = threading.local()
+
+
+def _calFigure() -> Figure:
+    # 每个渲染线程 / 进程复用一张 Agg 画布，不经过 pyplot 的全局状态
+    fig = getattr(_calLocal, 'figure', None)
+    if fig is None:
+        fig = _calLocal.figure = Figure()
+        FigureCanvasAgg(fig)
+    else:
+        fig.clear()
+    return fig
+
+
+def render_cal(sd_best: BestList, dx_best: BestList, encoder: ImageEncoder) -> EncodedImage:
+    X1 = list(np.arange(1, 26))
+    Y1 = []
+    for i in reversed(sd_best.data):
+        i: ChartInfo
+        Y1.append(i.ra)
+
+    X2 = list(np.arange(1, 16))
+    Y2 = []
+    for i in reversed(dx_best.data):
+        i: ChartInfo
+        Y2.append(i.ra)
+
+    fig = _calFigure()
+    ax1 = fig.add_subplot(211)
+    ax1.plot(X1, Y1, "ob:")
+
+    ax2 = fig.add_subplot(212)
+    ax2.plot(X2, Y2, "or:")
+
+    canvas = fig.canvas
+    canvas.draw()
+    return encoder.encode(Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1))
+
+
+async def generate_recommend(payload: Dict, n: int = 10) -> (Optional[Tuple[Dict, List[Tuple]]], int):
+    """推分推荐：返回 (玩家数据, [(乐曲, 难度下标, 当前达成率, 目标达成率, 目标 rating, rating 增量)])"""
+    status, obj = await player_cache.query_player(payload)
+    if status:
+        return None, status
+    music_list = get_total_list()
+    table = music_list.rating_table
+    sd_best, dx_best = BestList(25), BestList(15)
+    rows, achievements = [], []
+    # 进入 b40 的成绩与其谱面行，按对象 id 记录（值中保留对象本身，避免 id 被复用）
+    pushed: Dict[int, Tuple[ChartInfo, Optional[int]]] = {}
+    for kind, best in (("sd", sd_best), ("dx", dx_best)):
+        for c in obj["charts"][kind]:
+            # 同名的 SD / DX 谱面只能靠 song_id 区分
+            music = music_list.by_id(str(c["song_id"])) if "song_id" in c else music_list.by_title(c["title"])
+            row = table.row(music.id, c["level_index"]) if music is not None else None
+            if best.accepts(c["ra"]):
+                chart = ChartInfo.from_json(c)
+                best.push(chart)
+                pushed[id(chart)] = (chart, row)
+            if row is None:
+                continue
+            rows.append(row)
+            achievements.append(c["achievements"])
+    best_rows = [row for _, row in (pushed[id(c)] for c in sd_best.data + dx_best.data) if row is not None]
+    sd_floor = sd_best[-1].ra if len(sd_best) >= sd_best.size else 0
+    dx_floor = dx_best[-1].ra if len(dx_best) >= dx_best.size else 0
+    result = table.recommend(np.array(rows, dtype=np.int64), np.array(achievements, dtype=np.float64),
+                             np.array(best_rows, dtype=np.int64), sd_floor, dx_floor, n)
+    return (obj, [table.chart(row) + tuple(rest) for row, *rest in result]), 0
+
+
+async def generate_cal(payload: Dict, encoder: Optional[ImageEncoder] = None) -> (Optional[EncodedImage], bool):
+    status, best = await query_best(payload)
+    if status:
+        return None, status
+    return await render_pool.run(render_cal, best.sd_best, best.dx_best, encoder or encoder_for('cal')), 0
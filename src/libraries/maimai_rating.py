@@ -0,0 +1,120 @@
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from src.libraries.maimaidx_music import Music
+
+ArrayLike = Union[float, np.ndarray, List[float]]
+
+# 达成率区间的下界与对应系数，与 computeRa 的 if/elif 链一一对应；
+# 50% 以下落入 "achievement < 70" 分支，系数为 6.0 而不是 5.0，这里保持相同的行为
+ACHIEVEMENT_BOUNDS = np.array([50, 60, 70, 75, 80, 90, 94, 97, 98, 99, 99.5, 99.99, 100, 100.5])
+RATING_FACTORS = np.array([6.0, 5.0, 6.0, 7.0, 7.5, 8.0, 9.0, 9.4, 10.0, 11.0, 12.0, 13.0, 13.5, 14.0, 15.0])
+MAX_ACHIEVEMENT = 101.0
+_LOWER = np.concatenate(([0.0], ACHIEVEMENT_BOUNDS))
+_UPPER = np.concatenate((ACHIEVEMENT_BOUNDS, [np.inf]))
+_STEP = 0.0001  # 达成率的最小单位
+
+
+def compute_ra(ds: ArrayLike, achievement: ArrayLike) -> np.ndarray:
+    """向量化的 computeRa，支持广播，结果与逐个调用 computeRa 完全相同"""
+    ds = np.asarray(ds, dtype=np.float64)
+    achievement = np.asarray(achievement, dtype=np.float64)
+    factor = RATING_FACTORS[np.searchsorted(ACHIEVEMENT_BOUNDS, achievement, side='right')]
+    # 运算顺序与 computeRa 保持一致，保证浮点结果逐位相同
+    return np.floor(ds * (np.minimum(100.5, achievement) / 100) * factor).astype(np.int64)
+
+
+def min_achievement(ds: ArrayLike, ra: ArrayLike) -> np.ndarray:
+    """达到 ra 所需的最低达成率（以 0.0001 为单位），无法达到时为 nan；支持广播"""
+    ds, ra = np.broadcast_arrays(np.asarray(ds, dtype=np.float64), np.asarray(ra, dtype=np.float64))
+    ds = ds[..., None]
+    ra = ra[..., None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        need = ra * 100 / (ds * RATING_FACTORS)
+    # 每个区间内 rating 随达成率单调不减，取区间内满足条件的最小值，再在区间之间取最小
+    candidate = np.maximum(np.ceil(np.round(need / _STEP, 6)) * _STEP, _LOWER)
+    candidate = np.round(candidate, 4)
+    # 浮点误差可能让估计值偏离一个单位，用 compute_ra 校正
+    low = np.round(candidate - _STEP, 4)
+    candidate = np.where((low >= _LOWER) & (compute_ra(ds, low) >= ra), low, candidate)
+    high = np.round(candidate + _STEP, 4)
+    candidate = np.where(compute_ra(ds, candidate) >= ra, candidate, high)
+    valid = (candidate < _UPPER) & (candidate <= MAX_ACHIEVEMENT) & (compute_ra(ds, candidate) >= ra)
+    candidate = np.where(valid, candidate, np.inf).min(axis=-1)
+    return np.where(np.isinf(candidate), np.nan, candidate)
+
+
+class RatingTable(object):
+    """把乐曲列表中的所有谱面展开成列向量（定数、所属乐曲、难度、是否新曲），并预先计算每个谱面达到各个 rating
+    所需的最低达成率"""
+
+    def __init__(self, music_list: List[Music]):
+        self.musics = list(music_list)
+        self.music_index = np.array([i for i, music in enumerate(self.musics) for _ in music.ds], dtype=np.int32)
+        self.level_index = np.array([j for music in self.musics for j in range(len(music.ds))], dtype=np.int8)
+        self.ds = np.array([ds for music in self.musics for ds in music.ds], dtype=np.float64)
+        self.is_new = np.array([bool(music.is_new) for music in self.musics for _ in music.ds], dtype=bool)
+        self._rows = {(music.id, j): row for row, (music, j) in enumerate(self.charts())}
+        self._thresholds: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self.ds)
+
+    def charts(self) -> List[Tuple[Music, int]]:
+        return [(self.musics[i], int(j)) for i, j in zip(self.music_index, self.level_index)]
+
+    def chart(self, row: int) -> Tuple[Music, int]:
+        return self.musics[self.music_index[row]], int(self.level_index[row])
+
+    def row(self, music_id: str, level_index: int) -> Optional[int]:
+        return self._rows.get((music_id, level_index))
+
+    @property
+    def max_ra(self) -> int:
+        """所有谱面能达到的最高 rating"""
+        return int(compute_ra(self.ds, 100.5).max()) if len(self.ds) else 0
+
+    @property
+    def thresholds(self) -> np.ndarray:
+        """形状为 (谱面数, max_ra + 1) 的表，thresholds[row, ra] 为该谱面达到 ra 所需的最低达成率，无法达到为 nan"""
+        if self._thresholds is None:
+            ra = np.arange(self.max_ra + 1, dtype=np.float64)
+            # 不同的定数只有一百多种，按定数去重后计算再展开
+            unique_ds, inverse = np.unique(self.ds, return_inverse=True)
+            self._thresholds = min_achievement(unique_ds[:, None], ra[None, :])[inverse]
+        return self._thresholds
+
+    def min_achievement(self, rows: np.ndarray, ra: np.ndarray) -> np.ndarray:
+        """查表得到各谱面达到对应 ra 的最低达成率，超出表范围的 ra 为 nan"""
+        rows = np.asarray(rows)
+        ra = np.asarray(ra, dtype=np.int64)
+        table = self.thresholds
+        inside = (ra >= 0) & (ra < table.shape[1])
+        return np.where(inside, table[rows, np.clip(ra, 0, table.shape[1] - 1)], np.nan)
+
+    def compute_ra(self, rows: np.ndarray, achievement: ArrayLike) -> np.ndarray:
+        return compute_ra(self.ds[rows], achievement)
+
+    def recommend(self, played_rows: np.ndarray, played_achievements: np.ndarray, best_rows: np.ndarray,
+                  sd_floor: int, dx_floor: int,
+                  n: int = 10) -> List[Tuple[int, float, float, int, int]]:
+        """找出提升 b40 所需达成率增量最小的谱面。
+        旧曲与 sd_floor（b25 中的最低 rating，未满时为 0）比较，新曲与 dx_floor 比较；已在 b40 中的谱面只需超过自身。
+        返回 [(row, 当前达成率, 目标达成率, 目标 rating, rating 增量)]，按达成率增量从小到大排列"""
+        current = np.zeros(len(self))
+        current[played_rows] = played_achievements
+        current_ra = compute_ra(self.ds, current)
+        beat = np.where(self.is_new, dx_floor, sd_floor)
+        in_best = np.zeros(len(self), dtype=bool)
+        in_best[best_rows] = True
+        beat = np.where(in_best, current_ra, beat)
+        target = self.min_achievement(np.arange(len(self)), beat + 1)
+        valid = np.nonzero(target > current)[0]
+        target = target[valid]
+        delta = target - current[valid]
+        target_ra = self.compute_ra(valid, target)
+        gain = target_ra - beat[valid]
+        order = np.lexsort((-self.ds[valid], -gain, delta))[:n]
+        return [(int(valid[k]), float(current[valid[k]]), float(target[k]), int(target_ra[k]), int(gain[k]))
+                for k in order]
@@ -0,0 +1,125 @@
+import asyncio
+import os
+from typing import List, Optional, Set, Tuple
+
+import pygtrie
+
+from src.libraries.maimaidx_music import MusicList, get_total_list, normalize_title
+
+ALIAS_FILE = 'src/static/aliases.tsv'
+
+Stamp = Tuple[int, int]
+
+
+def read_alias_file(path: str) -> List[Tuple[str, List[str]]]:
+    """别名表每行为 `乐曲 id 或标题<TAB>别名<TAB>别名...`，空行与 # 开头的行忽略"""
+    entries = []
+    with open(path, encoding='utf-8-sig') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            name, *aliases = line.split('\t')
+            entries.append((name.strip(), [alias.strip() for alias in aliases if alias.strip()]))
+    return entries
+
+
+class AliasIndex(object):
+    """归一化别名到乐曲 id 的前缀树，精确查询与前缀查询的耗时只与别名长度有关"""
+
+    def __init__(self, entries: List[Tuple[str, List[str]]], music_list: MusicList):
+        self.music_list = music_list
+        self.trie = pygtrie.CharTrie()
+        self.unresolved: List[str] = []
+        # 标题本身也可以当作别名，没有别名表时也能按标题查歌
+        for music in music_list:
+            self._add(music.title, music.id)
+        for name, aliases in entries:
+            music = music_list.by_id(name) or music_list.by_title(name)
+            if music is None:
+                self.unresolved.append(name)
+                continue
+            for alias in aliases:
+                self._add(alias, music.id)
+
+    def _add(self, alias: str, music_id: str):
+        key = normalize_title(alias)
+        if not key:
+            return
+        ids: Optional[List[str]] = self.trie.get(key)
+        if ids is None:
+            self.trie[key] = [music_id]
+        elif music_id not in ids:
+            ids.append(music_id)
+
+    def __len__(self):
+        return len(self.trie)
+
+    def lookup(self, alias: str) -> List[str]:
+        """别名对应的乐曲 id，标题在前，其余按别名表中出现的顺序"""
+        return list(self.trie.get(normalize_title(alias), ()))
+
+    def complete(self, prefix: str, limit: int = 10) -> List[str]:
+        """以 prefix 开头的别名对应的乐曲 id，去重后最多返回 limit 个"""
+        key = normalize_title(prefix)
+        if not key or not self.trie.has_node(key):
+            return []
+        result: List[str] = []
+        seen: Set[str] = set()
+        for ids in self.trie.itervalues(prefix=key):
+            for music_id in ids:
+                if music_id not in seen:
+                    seen.add(music_id)
+                    result.append(music_id)
+                    if len(result) >= limit:
+                        return result
+        return result
+
+
+class AliasLoader(object):
+    """从本地别名表构建 AliasIndex；文件或 total_list 变化后在线程池中重建并整体替换，查询方不会被阻塞"""
+
+    def __init__(self, path: str = ALIAS_FILE):
+        self.path = path
+        self.index = AliasIndex([], MusicList())
+        self._stamp: Optional[Stamp] = None
+
+    def _file_stamp(self) -> Optional[Stamp]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _build(self, music_list: MusicList) -> AliasIndex:
+        entries = read_alias_file(self.path) if os.path.exists(self.path) else []
+        return AliasIndex(entries, music_list)
+
+    def stale(self) -> bool:
+        return self._file_stamp() != self._stamp or self.index.music_list is not get_total_list()
+
+    def load(self) -> bool:
+        """同步重建，数据未变化时返回 False"""
+        if not self.stale():
+            return False
+        stamp, music_list = self._file_stamp(), get_total_list()
+        self.index = self._build(music_list)
+        self._stamp = stamp
+        return True
+
+    async def refresh(self) -> bool:
+        if not self.stale():
+            return False
+        stamp, music_list = self._file_stamp(), get_total_list()
+        self.index = await asyncio.get_running_loop().run_in_executor(None, self._build, music_list)
+        self._stamp = stamp
+        return True
+
+    def lookup(self, alias: str) -> List[str]:
+        return self.index.lookup(alias)
+
+    def complete(self, prefix: str, limit: int = 10) -> List[str]:
+        return self.index.complete(prefix, limit)
+
+
+alias_loader = AliasLoader()
@@ -1,8 +1,19 @@
+import asyncio
+import heapq
+import json
+import mmap
+import os
 import random
-from copy import deepcopy
-from typing import Dict, List, Optional, Union, Tuple, Any
+import struct
+import unicodedata
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Dict, List, Optional, Union, Tuple, Any, Set
 
-import requests
+import aiohttp
+import numpy as np
 
 
 def get_cover_len4_id(mid) -> str:
@@ -12,6 +23,32 @@ def get_cover_len4_id(mid) -> str:
     return f'{mid:04d}'
 
 
+def _Q2B(uchar):
+    """单个字符 全角转半角"""
+    inside_code = ord(uchar)
+    if inside_code == 0x3000:
+        inside_code = 0x0020
+    else:
+        inside_code -= 0xfee0
+    if inside_code < 0x0020 or inside_code > 0x7e:  # 转完之后不是半角字符返回原来的字符
+        return uchar
+    return chr(inside_code)
+
+
+def _stringQ2B(ustring):
+    """把字符串全角转半角"""
+    return "".join([_Q2B(uchar) for uchar in ustring])
+
+
+# 片假名折叠为平假名
+_KANA_FOLD = {code: code - 0x60 for code in range(0x30a1, 0x30f7)}
+
+
+def normalize_title(title: str) -> str:
+    """查歌用的标题归一化：全角转半角、兼容字符折叠、小写、片假名转平假名"""
+    return unicodedata.normalize('NFKC', _stringQ2B(title)).lower().translate(_KANA_FOLD)
+
+
 def cross(checker: List[Any], elem: Optional[Union[Any, List[Any]]], diff):
     ret = False
     diff_ret = []
@@ -54,71 +91,513 @@ def in_or_equal(checker: Any, elem: Optional[Union[Any, List[Any]]]):
         return checker == elem
 
 
-class Chart(Dict):
-    tap: Optional[int] = None
-    slide: Optional[int] = None
-    hold: Optional[int] = None
-    touch: Optional[int] = None
-    brk: Optional[int] = None  # break
-    charter: Optional[int] = None  # 铺师
-
-    def __getattribute__(self, item):
-        if item == 'tap':
-            return self['notes'][0]
-        elif item == 'hold':
-            return self['notes'][1]
-        elif item == 'slide':
-            return self['notes'][2]
-        elif item == 'touch':
-            return self['notes'][3] if len(self['notes']) == 5 else 0
-        elif item == 'brk':
-            return self['notes'][-1]
-        elif item == 'charter':
-            return self['charter']
-        return super().__getattribute__(item)
-
-
-class Music(Dict):
-    id: Optional[str] = None
-    title: Optional[str] = None
-    ds: Optional[List[float]] = None
-    level: Optional[List[str]] = None
-    genre: Optional[str] = None
-    type: Optional[str] = None
-    bpm: Optional[float] = None
-    version: Optional[str] = None
-    charts: Optional[Chart] = None
-    release_date: Optional[str] = None
-    artist: Optional[str] = None
-
-    diff: List[int] = []
-
-    def __getattribute__(self, item):
-        if item in {'genre', 'artist', 'release_date', 'bpm', 'version'}:
-            if item == 'version':
-                return self['basic_info']['from']
-            return self['basic_info'][item]
-        elif item in self:
-            return self[item]
-        return super().__getattribute__(item)
+class _Record(Mapping):
+    """只读记录：字段直接存放在 __slots__ 里，同时保留 music['ds'] 这样的只读字典式访问"""
+    __slots__ = ('_extras',)
+    _keys: Tuple[str, ...] = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def __delattr__(self, key):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            return getattr(self, key)
+        return self._extras[key]
+
+    def __iter__(self):
+        yield from self._keys
+        yield from self._extras
+
+    def __len__(self):
+        return len(self._keys) + len(self._extras)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+
+
+class Chart(_Record):
+    __slots__ = ('notes', 'charter', 'tap', 'hold', 'slide', 'touch', 'brk')
+    _keys = ('notes', 'charter')
+
+    def __init__(self, notes: Tuple[int, ...], charter: str, extras: Optional[Dict[str, Any]] = None):
+        notes = tuple(notes)
+        _set = object.__setattr__
+        _set(self, 'notes', notes)
+        _set(self, 'charter', charter)  # 铺师
+        _set(self, 'tap', notes[0])
+        _set(self, 'hold', notes[1])
+        _set(self, 'slide', notes[2])
+        _set(self, 'touch', notes[3] if len(notes) == 5 else 0)
+        _set(self, 'brk', notes[-1])  # break
+        _set(self, '_extras', MappingProxyType(dict(extras or {})))
+
+    def __reduce__(self):
+        return Chart, (self.notes, self.charter, dict(self._extras))
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'Chart':
+        return cls(data['notes'], data['charter'], {k: v for k, v in data.items() if k not in cls._keys})
+
+
+class Music(_Record):
+    __slots__ = ('id', 'title', 'type', 'ds', 'level', 'cids', 'charts', 'basic_info',
+                 'genre', 'artist', 'release_date', 'bpm', 'version', 'is_new')
+    _keys = ('id', 'title', 'type', 'ds', 'level', 'cids', 'charts', 'basic_info')
+
+    def __init__(self, id: str, title: str, type: str, ds: Tuple[float, ...], level: Tuple[str, ...],
+                 cids: Tuple[int, ...], charts: Tuple[Chart, ...], basic_info: Dict[str, Any],
+                 extras: Optional[Dict[str, Any]] = None):
+        _set = object.__setattr__
+        _set(self, 'id', id)
+        _set(self, 'title', title)
+        _set(self, 'type', type)
+        _set(self, 'ds', tuple(ds))
+        _set(self, 'level', tuple(level))
+        _set(self, 'cids', tuple(cids))
+        _set(self, 'charts', tuple(charts))
+        _set(self, 'basic_info', MappingProxyType(dict(basic_info)))
+        _set(self, 'genre', basic_info['genre'])
+        _set(self, 'artist', basic_info['artist'])
+        _set(self, 'release_date', basic_info['release_date'])
+        _set(self, 'bpm', basic_info['bpm'])
+        _set(self, 'version', basic_info['from'])
+        _set(self, 'is_new', basic_info.get('is_new', False))
+        _set(self, '_extras', MappingProxyType(dict(extras or {})))
+
+    def __reduce__(self):
+        return Music, (self.id, self.title, self.type, self.ds, self.level, self.cids, self.charts,
+                       dict(self.basic_info), dict(self._extras))
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'Music':
+        return cls(data['id'], data['title'], data['type'], data['ds'], data['level'], data['cids'],
+                   tuple(Chart.from_json(chart) for chart in data['charts']), data['basic_info'],
+                   {k: v for k, v in data.items() if k not in cls._keys})
+
+
+class MusicView(Mapping):
+    """筛选结果中的乐曲：引用原乐曲，只额外记录匹配的难度下标"""
+    __slots__ = ('music', 'diff')
+
+    def __init__(self, music: Music, diff: List[int]):
+        self.music = music.music if isinstance(music, MusicView) else music
+        self.diff = diff
+
+    def __getattr__(self, item):
+        if item == 'music':
+            raise AttributeError(item)
+        return getattr(self.music, item)
+
+    def __getitem__(self, key):
+        return self.music[key]
+
+    def __iter__(self):
+        return iter(self.music)
+
+    def __len__(self):
+        return len(self.music)
+
+    def __repr__(self):
+        return f'MusicView({self.music!r}, diff={self.diff!r})'
+
+
+class _CategoryColumn(object):
+    """按取值编码的列，谓词只需在去重后的取值上各求一次"""
+
+    def __init__(self, rows: List[List[Any]], width: Optional[int] = None):
+        self.values: List[Any] = []
+        lookup: Dict[Any, int] = {}
+        self.codes = np.full((len(rows), width or 1), -1, dtype=np.int32)
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row):
+                if value not in lookup:
+                    lookup[value] = len(self.values)
+                    self.values.append(value)
+                self.codes[i, j] = lookup[value]
+        if width is None:
+            self.codes = self.codes[:, 0]
+
+    def match(self, elem) -> np.ndarray:
+        ok = np.array([in_or_equal(value, elem) for value in self.values] + [False], dtype=bool)
+        return ok[self.codes]
+
+
+def _match_numeric(column: np.ndarray, elem) -> np.ndarray:
+    if isinstance(elem, List):
+        return np.isin(column, elem)
+    elif isinstance(elem, Tuple):
+        return (elem[0] <= column) & (column <= elem[1])
+    else:
+        return column == elem
+
+
+class FilterIndex(object):
+    """MusicList.filter 使用的列式索引，每首歌一行，每个难度一列"""
+
+    def __init__(self, music_list: List[Music]):
+        self.musics = list(music_list)
+        self.chart_count = np.array([len(music.ds) for music in self.musics], dtype=np.int32)
+        width = int(self.chart_count.max()) if len(self.musics) else 1
+        self.ds = np.full((len(self.musics), width), np.nan)
+        for i, music in enumerate(self.musics):
+            self.ds[i, :len(music.ds)] = music.ds
+        self.level = _CategoryColumn([music.level for music in self.musics], width)
+        self.bpm = np.array([music.bpm for music in self.musics], dtype=np.float64)
+        self.genre = _CategoryColumn([[music.genre] for music in self.musics])
+        self.stype = _CategoryColumn([[music.type] for music in self.musics])
+        self.title = np.array([music.title.lower() for music in self.musics], dtype=np.str_)
+
+    @staticmethod
+    def _chain(row: np.ndarray, scalar: bool, diff):
+        # 与 cross 的语义保持一致：单个值只取第一个匹配的难度
+        hits = []
+        for j in (range(len(row)) if diff is Ellipsis else diff):
+            if j >= len(row):
+                continue
+            if row[j]:
+                if scalar:
+                    return [j]
+                hits.append(j)
+        return hits
+
+    def filter(self, *, level=..., ds=..., title_search=..., genre=..., bpm=..., stype=..., diff=...):
+        songs = np.ones(len(self.musics), dtype=bool)
+        chart_masks = []
+        for elem, match in ((level, self.level.match), (ds, lambda e: _match_numeric(self.ds, e))):
+            if not elem or elem is Ellipsis:
+                continue
+            mask = match(elem)
+            songs &= mask.any(axis=1)
+            chart_masks.append((mask, not isinstance(elem, (List, Tuple))))
+        if genre is not Ellipsis:
+            songs &= self.genre.match(genre)
+        if stype is not Ellipsis:
+            songs &= self.stype.match(stype)
+        if bpm is not Ellipsis:
+            songs &= _match_numeric(self.bpm, bpm)
+        if title_search is not Ellipsis:
+            songs &= np.char.find(self.title, title_search.lower()) >= 0
+
+        new_list = MusicList()
+        for i in np.flatnonzero(songs):
+            diff2 = diff
+            for mask, scalar in chart_masks:
+                diff2 = self._chain(mask[i, :self.chart_count[i]], scalar, diff2)
+                if not diff2:
+                    break
+            else:
+                new_list.append(MusicView(self.musics[i], diff2))
+        return new_list
+
+
+class DsIndex(object):
+    """所有谱面按 (定数, 歌曲 id, 难度下标) 排序的索引，定数查询只需二分加切片"""
+
+    def __init__(self, music_list: List[Music]):
+        entries = sorted(((ds, int(music.id), j, music) for music in music_list for j, ds in enumerate(music.ds)),
+                         key=lambda e: e[:3])
+        self.keys: List[float] = [e[0] for e in entries]
+        self.entries: List[Tuple[int, int, Music]] = [e[1:] for e in entries]
+        # 每段相同定数的谱面本身就是按 id 排好序的，记录段的起点以便归并
+        self.run_starts: List[int] = [i for i in range(len(self.keys)) if i == 0 or self.keys[i] != self.keys[i - 1]]
+
+    def _bounds(self, ds1: float, ds2: Optional[float]) -> Tuple[int, int]:
+        ds2 = ds1 if ds2 is None else ds2
+        start = bisect_left(self.keys, ds1)
+        return start, max(start, bisect_right(self.keys, ds2))
+
+    def count(self, ds1: float, ds2: Optional[float] = None) -> int:
+        start, end = self._bounds(ds1, ds2)
+        return end - start
+
+    def query(self, ds1: float, ds2: Optional[float] = None) -> List[Tuple[Music, int]]:
+        """返回定数在 [ds1, ds2] 内的 (乐曲, 难度下标)，按歌曲 id 与难度排序"""
+        start, end = self._bounds(ds1, ds2)
+        bounds = [start] + self.run_starts[bisect_right(self.run_starts, start):bisect_left(self.run_starts, end)] + [end]
+        runs = [self.entries[bounds[k]:bounds[k + 1]] for k in range(len(bounds) - 1)]
+        return [(music, j) for _, j, music in heapq.merge(*runs, key=lambda e: e[:2])]
+
+
+def _as_list(elem) -> Optional[List[Any]]:
+    if elem is Ellipsis or elem is None:
+        return None
+    return list(elem) if isinstance(elem, (List, Set, frozenset)) else [elem]
+
+
+class RandomIndex(object):
+    """带条件随机选谱用的分桶索引。所有谱面按 (定数, 歌曲 id, 难度下标) 编号，定数区间对应一段连续编号；
+    等级、分类、类型、难度各自预先分好桶，查询时从最小的桶出发用其余条件的编码列筛一遍再抽样"""
+
+    def __init__(self, music_list: List[Music]):
+        entries = sorted(((ds, int(music.id), j, music) for music in music_list for j, ds in enumerate(music.ds)),
+                         key=lambda e: e[:3])
+        self.charts: List[Tuple[Music, int]] = [(e[3], e[2]) for e in entries]
+        self.ds = np.array([e[0] for e in entries], dtype=np.float64)
+        self.diff = np.array([e[2] for e in entries], dtype=np.int8)
+        self.buckets: Dict[str, Dict[Any, np.ndarray]] = {}
+        self.codes: Dict[str, np.ndarray] = {}
+        self.values: Dict[str, Dict[Any, int]] = {}
+        for name, values in (('level', [music.level[j] for music, j in self.charts]),
+                             ('genre', [music.genre for music, _ in self.charts]),
+                             ('stype', [music.type for music, _ in self.charts]),
+                             ('diff', [j for _, j in self.charts])):
+            lookup: Dict[Any, int] = {}
+            codes = np.array([lookup.setdefault(value, len(lookup)) for value in values], dtype=np.int32)
+            self.values[name] = lookup
+            self.codes[name] = codes
+            self.buckets[name] = {value: np.flatnonzero(codes == code) for value, code in lookup.items()}
+
+    def _ds_range(self, ds) -> Tuple[int, int]:
+        if isinstance(ds, Tuple):
+            lo, hi = ds
+        else:
+            lo = hi = ds
+        return int(np.searchsorted(self.ds, lo, 'left')), int(np.searchsorted(self.ds, hi, 'right'))
+
+    def candidates(self, *, level=..., ds=..., genre=..., stype=..., diff=...) -> np.ndarray:
+        """满足条件的谱面编号；定数可以是单个值或 (下限, 上限)，其余条件可以是单个值或列表"""
+        start, end = (0, len(self.charts)) if ds is Ellipsis or ds is None else self._ds_range(ds)
+        wanted = [(name, values) for name, values in (('level', _as_list(level)), ('genre', _as_list(genre)),
+                                                      ('stype', _as_list(stype)), ('diff', _as_list(diff)))
+                  if values is not None]
+        # 每个条件的候选桶，多个取值的桶本身互不相交，直接拼起来
+        groups = []
+        for name, values in wanted:
+            buckets = [self.buckets[name][value] for value in values if value in self.buckets[name]]
+            groups.append((sum(len(b) for b in buckets), name, values, buckets))
+        if not groups:
+            return np.arange(start, end)
+        size, name, values, buckets = min(groups, key=lambda g: g[0])
+        if size >= end - start:
+            picked = np.arange(start, end)
+        else:
+            picked = np.concatenate(buckets) if buckets else np.empty(0, dtype=np.int64)
+            picked = picked[(picked >= start) & (picked < end)]
+        for _, other, values, _ in groups:
+            if other == name and size < end - start:
+                continue
+            codes = [self.values[other][value] for value in values if value in self.values[other]]
+            picked = picked[np.isin(self.codes[other][picked], codes)]
+        return picked
+
+    def pick(self, rng: Optional[random.Random] = None, **constraints) -> Optional[Tuple[Music, int]]:
+        picked = self.candidates(**constraints)
+        if len(picked) == 0:
+            return None
+        return self.charts[int(picked[(rng or random).randrange(len(picked))])]
+
+
+# TAP / HOLD / SLIDE / TOUCH / BREAK 的基础分，以及一个 GREAT 相当于几个 TAP GREAT
+NOTE_SCORES = np.array([500, 1000, 1500, 500, 2500], dtype=np.float64)
+GREAT_WEIGHTS = np.array([1, 2, 3, 1, 5], dtype=np.float64)
+
+
+class ScoreTable(object):
+    """分数线用的谱面表：每个谱面一行，预先算好总分、每种音符 GREAT 的达成率损失和 BREAK 的等价 TAP GREAT 数，
+    查询只需查表"""
+
+    def __init__(self, music_list: List[Music]):
+        self.charts: List[Tuple[Music, int]] = [(music, j) for music in music_list for j in range(len(music.charts))]
+        self._rows = {(music.id, j): row for row, (music, j) in enumerate(self.charts)}
+        notes = np.zeros((len(self.charts), 5), dtype=np.int32)
+        for row, (music, j) in enumerate(self.charts):
+            chart = music.charts[j]
+            notes[row] = (chart.tap, chart.hold, chart.slide, chart.touch, chart.brk)
+        self.notes = notes
+        self.total_score = notes @ NOTE_SCORES
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # 一个 TAP GREAT 扣 100 分
+            self.tap_great = 10000 / self.total_score
+            self.great_loss = self.tap_great[:, None] * GREAT_WEIGHTS
+            # BREAK 50落扣掉绝对加分的四分之一，GREAT 额外再扣 200落
+            self.break_50 = self.total_score * (0.01 / notes[:, 4]) / 4
+            self.break_50_loss = self.break_50 / self.total_score * 100
+            self.break_great = GREAT_WEIGHTS[4] * 100 + self.break_50 * 4
+
+    def __len__(self):
+        return len(self.charts)
+
+    def row(self, music_id: str, level_index: int) -> Optional[int]:
+        return self._rows.get((music_id, level_index))
+
+    def tolerance(self, row: int, lines: Union[float, List[float], np.ndarray]) -> np.ndarray:
+        """达到各分数线允许的最多 TAP GREAT 数量"""
+        return self.total_score[row] * (101 - np.asarray(lines, dtype=np.float64)) / 10000
+
+
+def _grams(s: str, n: int) -> Set[str]:
+    return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+
+class TitleSearchIndex(object):
+    """标题的 n-gram 倒排索引，子串查询只需检查候选乐曲"""
+
+    def __init__(self, music_list: List[Music], n: int = 2):
+        self.n = n
+        self.musics = list(music_list)
+        self.titles = [normalize_title(music.title) for music in self.musics]
+        self.postings: Dict[str, Set[int]] = {}
+        for i, title in enumerate(self.titles):
+            for gram in _grams(title, 1) | _grams(title, n):
+                self.postings.setdefault(gram, set()).add(i)
+        # 模糊查询打分用的每个标题的 gram 数，建索引时算一次
+        self.gram_counts: List[int] = [len(self._query_grams(title)) for title in self.titles]
+
+    def _query_grams(self, query: str) -> Set[str]:
+        return _grams(query, self.n) if len(query) >= self.n else _grams(query, 1)
+
+    def search(self, query: str) -> 'MusicList':
+        """返回标题包含 query 的乐曲，按原列表顺序排列"""
+        query = normalize_title(query)
+        postings = sorted((self.postings.get(gram, set()) for gram in self._query_grams(query)), key=len)
+        if not postings:
+            return MusicList(self.musics)
+        candidates = set.intersection(*postings)
+        return MusicList(self.musics[i] for i in sorted(candidates) if query in self.titles[i])
+
+    def fuzzy_search(self, query: str, limit: int = 10) -> List[Tuple[Music, float]]:
+        """按 n-gram 的 Dice 系数给标题打分，返回得分最高的若干首"""
+        query = normalize_title(query)
+        grams = self._query_grams(query)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        scored = []
+        for i, count in shared.items():
+            scored.append((2 * count / (len(grams) + self.gram_counts[i]), i))
+        scored.sort(key=lambda e: (-e[0], e[1]))
+        return [(self.musics[i], score) for score, i in scored[:limit]]
 
 
 class MusicList(List[Music]):
-    def by_id(self, music_id: str) -> Optional[Music]:
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._build_index()
+
+    def _build_index(self):
+        self._id_index: Dict[str, Music] = {}
+        self._title_index: Dict[str, Music] = {}
+        self._filter_index: Optional[FilterIndex] = None
+        self._ds_index: Optional[DsIndex] = None
+        self._title_search_index: Optional[TitleSearchIndex] = None
+        self._rating_table = None
+        self._random_index: Optional[RandomIndex] = None
+        self._score_table: Optional[ScoreTable] = None
         for music in self:
-            if music.id == music_id:
-                return music
-        return None
+            self._add_index(music)
+
+    def _add_index(self, music: Music):
+        self._filter_index = None
+        self._ds_index = None
+        self._title_search_index = None
+        self._rating_table = None
+        self._random_index = None
+        self._score_table = None
+        # 与逐个遍历一致，重复的 id 或标题以最先出现的为准
+        self._id_index.setdefault(music.id, music)
+        self._title_index.setdefault(music.title, music)
+
+    def append(self, music: Music):
+        super().append(music)
+        self._add_index(music)
+
+    def extend(self, musics):
+        start = len(self)
+        super().extend(musics)
+        for music in self[start:]:
+            self._add_index(music)
+
+    def __iadd__(self, musics):
+        self.extend(musics)
+        return self
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._build_index()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._build_index()
+
+    def insert(self, index, music: Music):
+        super().insert(index, music)
+        self._build_index()
+
+    def pop(self, index=-1):
+        music = super().pop(index)
+        self._build_index()
+        return music
+
+    def remove(self, music: Music):
+        super().remove(music)
+        self._build_index()
+
+    def clear(self):
+        super().clear()
+        self._build_index()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._build_index()
+
+    def reverse(self):
+        super().reverse()
+        self._build_index()
+
+    def by_id(self, music_id: str) -> Optional[Music]:
+        return self._id_index.get(music_id)
 
     def by_title(self, music_title: str) -> Optional[Music]:
-        for music in self:
-            if music.title == music_title:
-                return music
-        return None
+        return self._title_index.get(music_title)
+
+    @property
+    def ds_index(self) -> DsIndex:
+        if self._ds_index is None:
+            self._ds_index = DsIndex(self)
+        return self._ds_index
+
+    @property
+    def title_index(self) -> TitleSearchIndex:
+        if self._title_search_index is None:
+            self._title_search_index = TitleSearchIndex(self)
+        return self._title_search_index
+
+    @property
+    def rating_table(self):
+        """谱面 rating 阈值表，见 maimai_rating.RatingTable"""
+        if self._rating_table is None:
+            from src.libraries.maimai_rating import RatingTable
+            self._rating_table = RatingTable(self)
+        return self._rating_table
+
+    @property
+    def random_index(self) -> RandomIndex:
+        if self._random_index is None:
+            self._random_index = RandomIndex(self)
+        return self._random_index
+
+    @property
+    def score_table(self) -> ScoreTable:
+        if self._score_table is None:
+            self._score_table = ScoreTable(self)
+        return self._score_table
 
     def random(self):
         return random.choice(self)
 
+    def random_chart(self, *, level: Optional[Union[str, List[str]]] = ...,
+                     ds: Optional[Union[float, Tuple[float, float]]] = ...,
+                     genre: Optional[Union[str, List[str]]] = ...,
+                     stype: Optional[Union[str, List[str]]] = ...,
+                     diff: Optional[Union[int, List[int]]] = ...,
+                     rng: Optional['random.Random'] = None) -> Optional[Tuple[Music, int]]:
+        """在满足条件的谱面中等概率随机选一个，返回 (乐曲, 难度下标)，没有符合条件的谱面时返回 None；
+        传入 rng 可以得到可复现的结果"""
+        return self.random_index.pick(rng, level=level, ds=ds, genre=genre, stype=stype, diff=diff)
+
     def filter(self,
                *,
                level: Optional[Union[str, List[str]]] = ...,
@@ -129,32 +608,314 @@ class MusicList(List[Music]):
                stype: Optional[Union[str, List[str]]] = ...,
                diff: List[int] = ...,
                ):
-        new_list = MusicList()
-        for music in self:
-            diff2 = diff
-            music = deepcopy(music)
-            ret, diff2 = cross(music.level, level, diff2)
-            if not ret:
-                continue
-            ret, diff2 = cross(music.ds, ds, diff2)
-            if not ret:
-                continue
-            if not in_or_equal(music.genre, genre):
-                continue
-            if not in_or_equal(music.type, stype):
-                continue
-            if not in_or_equal(music.bpm, bpm):
-                continue
-            if title_search is not Ellipsis and title_search.lower() not in music.title.lower():
-                continue
-            music.diff = diff2
-            new_list.append(music)
-        return new_list
+        if self._filter_index is None:
+            self._filter_index = FilterIndex(self)
+        return self._filter_index.filter(level=level, ds=ds, title_search=title_search, genre=genre, bpm=bpm,
+                                         stype=stype, diff=diff)
+
+
+MUSIC_DATA_URL = 'https://www.diving-fish.com/api/maimaidxprober/music_data'
+MUSIC_DATA_SNAPSHOT = 'src/static/music_data.bin'
+
+
+def _build_indexes(music_list: MusicList) -> MusicList:
+    # 查歌索引与分数线表在加载时就建好
+    music_list.title_index
+    music_list.score_table
+    return music_list
+
+
+def build_music_list(obj: List[Dict]) -> MusicList:
+    return _build_indexes(MusicList(Music.from_json(music) for music in obj))
+
+
+def _parse_music_data(body: bytes) -> Tuple[List[Dict], MusicList]:
+    obj = json.loads(body)
+    return obj, build_music_list(obj)
+
+
+SNAPSHOT_MAGIC = b'MMDX'
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_PREFIX = struct.Struct('<4sHHI')
+_SONG_KEYS = ('id', 'title', 'type', 'ds', 'level', 'cids', 'charts', 'basic_info')
+_BASIC_INFO_KEYS = ('title', 'artist', 'genre', 'bpm', 'release_date', 'from', 'is_new')
+_CHART_KEYS = ('notes', 'charter')
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class MusicSnapshot(object):
+    """乐曲数据的二进制快照：定数、等级、物量等按列存储，标题、曲师、谱师等字符串放进字符串表，文件可直接 mmap 读取"""
+
+    def __init__(self, arrays: Dict[str, np.ndarray], strings: List[str], meta: Optional[Dict] = None,
+                 extras: Optional[List] = None, buffer: Optional[mmap.mmap] = None):
+        self.arrays = arrays
+        self.strings = strings
+        self.meta = meta or {}
+        # 不在固定格式内的字段原样记在这里，保证与 JSON 互相转换不丢信息
+        self.extras = extras or []
+        self._buffer = buffer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.arrays = {}
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+    @classmethod
+    def from_json(cls, obj: List[Dict], meta: Optional[Dict] = None) -> 'MusicSnapshot':
+        strings: List[str] = []
+        lookup: Dict[str, int] = {}
+
+        def intern(value: str) -> int:
+            if value not in lookup:
+                lookup[value] = len(strings)
+                strings.append(value)
+            return lookup[value]
+
+        columns: Dict[str, List] = {name: [] for name in (
+            'song_id', 'song_title', 'song_type', 'info_title', 'info_artist', 'info_genre', 'info_release_date',
+            'info_from', 'info_bpm', 'info_bpm_int', 'info_is_new', 'chart_ds', 'chart_level', 'chart_cid',
+            'chart_charter', 'chart_notes', 'chart_note_count')}
+        chart_offset = [0]
+        extras = []
+        for i, music in enumerate(obj):
+            info = music['basic_info']
+            if not len(music['ds']) == len(music['level']) == len(music['cids']) == len(music['charts']):
+                raise ValueError(f"乐曲 {music['id']} 的谱面数量不一致")
+            extras += [[i, 'song', key, value] for key, value in music.items() if key not in _SONG_KEYS]
+            extras += [[i, 'basic_info', key, value] for key, value in info.items() if key not in _BASIC_INFO_KEYS]
+            for key in ('id', 'title', 'type'):
+                columns[f'song_{key}'].append(intern(music[key]))
+            for key in ('title', 'artist', 'genre', 'release_date', 'from'):
+                columns[f'info_{key}'].append(intern(info[key]))
+            columns['info_bpm'].append(info['bpm'])
+            columns['info_bpm_int'].append(isinstance(info['bpm'], int))
+            columns['info_is_new'].append(info['is_new'])
+            for j, chart in enumerate(music['charts']):
+                extras += [[i, 'chart', j, key, value] for key, value in chart.items() if key not in _CHART_KEYS]
+                columns['chart_ds'].append(music['ds'][j])
+                columns['chart_level'].append(intern(music['level'][j]))
+                columns['chart_cid'].append(music['cids'][j])
+                columns['chart_charter'].append(intern(chart['charter']))
+                columns['chart_notes'].append(list(chart['notes']) + [0] * (5 - len(chart['notes'])))
+                columns['chart_note_count'].append(len(chart['notes']))
+            chart_offset.append(chart_offset[-1] + len(music['charts']))
+
+        dtypes = {'info_bpm': np.float64, 'info_bpm_int': np.uint8, 'info_is_new': np.uint8,
+                  'chart_ds': np.float64, 'chart_cid': np.int64, 'chart_note_count': np.uint8}
+        arrays = {name: np.array(values, dtype=dtypes.get(name, np.int32)) for name, values in columns.items()}
+        arrays['chart_notes'] = arrays['chart_notes'].reshape(-1, 5)
+        arrays['chart_offset'] = np.array(chart_offset, dtype=np.int32)
+        return cls(arrays, strings, meta, extras)
+
+    def to_json(self) -> List[Dict]:
+        a = {name: array.tolist() for name, array in self.arrays.items()}
+        s = self.strings
+        offset = a['chart_offset']
+        obj = []
+        for i in range(len(offset) - 1):
+            lo, hi = offset[i], offset[i + 1]
+            obj.append({
+                'id': s[a['song_id'][i]],
+                'title': s[a['song_title'][i]],
+                'type': s[a['song_type'][i]],
+                'ds': a['chart_ds'][lo:hi],
+                'level': [s[k] for k in a['chart_level'][lo:hi]],
+                'cids': a['chart_cid'][lo:hi],
+                'charts': [{'notes': a['chart_notes'][j][:a['chart_note_count'][j]],
+                            'charter': s[a['chart_charter'][j]]} for j in range(lo, hi)],
+                'basic_info': {
+                    'title': s[a['info_title'][i]],
+                    'artist': s[a['info_artist'][i]],
+                    'genre': s[a['info_genre'][i]],
+                    'bpm': int(a['info_bpm'][i]) if a['info_bpm_int'][i] else a['info_bpm'][i],
+                    'release_date': s[a['info_release_date'][i]],
+                    'from': s[a['info_from'][i]],
+                    'is_new': bool(a['info_is_new'][i]),
+                },
+            })
+        for extra in self.extras:
+            if extra[1] == 'song':
+                obj[extra[0]][extra[2]] = extra[3]
+            elif extra[1] == 'basic_info':
+                obj[extra[0]]['basic_info'][extra[2]] = extra[3]
+            else:
+                obj[extra[0]]['charts'][extra[2]][extra[3]] = extra[4]
+        return obj
+
+    def to_musics(self) -> List[Music]:
+        """直接由各列构造 Music，不经过 to_json 的中间字典"""
+        a = {name: array.tolist() for name, array in self.arrays.items()}
+        s = self.strings
+        offset = a['chart_offset']
+        song_extras: Dict[int, Dict[str, Any]] = {}
+        info_extras: Dict[int, Dict[str, Any]] = {}
+        chart_extras: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        for extra in self.extras:
+            if extra[1] == 'song':
+                song_extras.setdefault(extra[0], {})[extra[2]] = extra[3]
+            elif extra[1] == 'basic_info':
+                info_extras.setdefault(extra[0], {})[extra[2]] = extra[3]
+            else:
+                chart_extras.setdefault((extra[0], extra[2]), {})[extra[3]] = extra[4]
+        musics = []
+        for i in range(len(offset) - 1):
+            lo, hi = offset[i], offset[i + 1]
+            charts = tuple(Chart(a['chart_notes'][j][:a['chart_note_count'][j]], s[a['chart_charter'][j]],
+                                 chart_extras.get((i, j - lo))) for j in range(lo, hi))
+            basic_info = {
+                'title': s[a['info_title'][i]],
+                'artist': s[a['info_artist'][i]],
+                'genre': s[a['info_genre'][i]],
+                'bpm': int(a['info_bpm'][i]) if a['info_bpm_int'][i] else a['info_bpm'][i],
+                'release_date': s[a['info_release_date'][i]],
+                'from': s[a['info_from'][i]],
+                'is_new': bool(a['info_is_new'][i]),
+            }
+            basic_info.update(info_extras.get(i, {}))
+            musics.append(Music(s[a['song_id'][i]], s[a['song_title'][i]], s[a['song_type'][i]], a['chart_ds'][lo:hi],
+                                [s[k] for k in a['chart_level'][lo:hi]], a['chart_cid'][lo:hi], charts, basic_info,
+                                song_extras.get(i)))
+        return musics
+
+    def dump(self, path: str):
+        encoded = [string.encode('utf-8') for string in self.strings]
+        arrays = dict(self.arrays)
+        arrays['string_offset'] = np.cumsum([0] + [len(string) for string in encoded], dtype=np.int64)
+        arrays['string_data'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            offset = _align(offset)
+            layout[name] = [array.dtype.str, list(array.shape), offset]
+            offset += array.nbytes
+        header = json.dumps({'arrays': layout, 'meta': self.meta, 'extras': self.extras},
+                            ensure_ascii=False).encode('utf-8')
+        data_start = _align(_SNAPSHOT_PREFIX.size + len(header))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_SNAPSHOT_PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(header)))
+            f.write(header)
+            for name, array in arrays.items():
+                f.write(b'\0' * (data_start + layout[name][2] - f.tell()))
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'MusicSnapshot':
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(buffer) < _SNAPSHOT_PREFIX.size:
+                raise ValueError('快照文件不完整')
+            magic, version, _, header_len = _SNAPSHOT_PREFIX.unpack_from(buffer)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError(f'不支持的快照格式：{magic!r} v{version}')
+            try:
+                header = json.loads(buffer[_SNAPSHOT_PREFIX.size:_SNAPSHOT_PREFIX.size + header_len].decode('utf-8'))
+                data_start = _align(_SNAPSHOT_PREFIX.size + header_len)
+                arrays = {}
+                for name, (dtype, shape, offset) in header['arrays'].items():
+                    arrays[name] = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)),
+                                                 offset=data_start + offset).reshape(shape)
+                string_offset = arrays.pop('string_offset').tolist()
+                string_data = arrays.pop('string_data')
+                strings = [string_data[string_offset[k]:string_offset[k + 1]].tobytes().decode('utf-8')
+                           for k in range(len(string_offset) - 1)]
+                meta, extras = header['meta'], header['extras']
+            except ValueError:
+                raise
+            except Exception as e:
+                # 头部缺字段、数组越界等都按格式错误处理，调用方只需处理 OSError / ValueError
+                raise ValueError(f'快照文件已损坏：{e!r}') from e
+        except Exception:
+            buffer.close()
+            raise
+        return cls(arrays, strings, meta, extras, buffer)
+
+
+class MusicDataLoader(object):
+    """启动时读取本地快照，之后用 ETag / If-Modified-Since 在后台刷新，刷新完成后整体替换 total_list"""
+
+    def __init__(self, url: str = MUSIC_DATA_URL, snapshot_path: str = MUSIC_DATA_SNAPSHOT,
+                 timeout: float = 30):
+        self.url = url
+        self.snapshot_path = snapshot_path
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.snapshot_error: Optional[Exception] = None
+        self.total_list = MusicList()
+
+    def _swap(self, music_list: MusicList):
+        global total_list
+        self.total_list = total_list = music_list
+
+    def load_snapshot(self) -> bool:
+        # 快照只用来加快启动：Music 与索引直接由映射的各列构造，构造完成后关闭映射，常驻内存的仍是 Python 对象
+        # 快照损坏时当作没有快照，等后台刷新重新写入；原因记在 snapshot_error 里由插件输出日志
+        self.snapshot_error = None
+        try:
+            with MusicSnapshot.load(self.snapshot_path) as snapshot:
+                music_list, meta = _build_indexes(MusicList(snapshot.to_musics())), snapshot.meta
+            etag, last_modified = meta.get('etag'), meta.get('last_modified')
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            self.snapshot_error = e
+            return False
+        self.etag, self.last_modified = etag, last_modified
+        self._swap(music_list)
+        return True
+
+    def _save_snapshot(self, obj: List[Dict], meta: Dict[str, Optional[str]]):
+        MusicSnapshot.from_json(obj, meta).dump(self.snapshot_path)
+
+    async def refresh(self, session: Optional[aiohttp.ClientSession] = None) -> bool:
+        """拉取最新数据，数据未变化时返回 False；快照写入失败不影响本次更新，原因记在 snapshot_error 里"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        if session is None:
+            async with aiohttp.ClientSession(timeout=self.timeout) as session:
+                return await self.refresh(session)
+        async with session.get(self.url, headers=headers) as resp:
+            if resp.status == 304:
+                return False
+            resp.raise_for_status()
+            body = await resp.read()
+            meta = {'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')}
+        loop = asyncio.get_running_loop()
+        # 解析 JSON、构建列表与索引、写快照都放到线程池里，避免阻塞事件循环
+        obj, music_list = await loop.run_in_executor(None, _parse_music_data, body)
+        self._swap(music_list)
+        self.snapshot_error = None
+        try:
+            await loop.run_in_executor(None, self._save_snapshot, obj, meta)
+        except Exception as e:
+            # 快照没写成时不记录 ETag，下次刷新会重新下载并再次写入
+            self.snapshot_error = e
+            self.etag = self.last_modified = None
+        else:
+            self.etag, self.last_modified = meta['etag'], meta['last_modified']
+        return True
+
+
+def get_total_list() -> MusicList:
+    return total_list
 
 
-obj = requests.get('https://www.diving-fish.com/api/maimaidxprober/music_data').json()
-total_list: MusicList = MusicList(obj)
-for __i in range(len(total_list)):
-    total_list[__i] = Music(total_list[__i])
-    for __j in range(len(total_list[__i].charts)):
-        total_list[__i].charts[__j] = Chart(total_list[__i].charts[__j])
+total_list: MusicList = MusicList()
+music_data_loader = MusicDataLoader()
+music_data_loader.load_snapshot()
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Hashable
+
+import aiohttp
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+PROBER_URL = 'https://www.diving-fish.com/api/maimaidxprober'
+
+
+_STRUCTURAL = re.compile(rb'[{}\[\],:"\\]')
+_SEPARATORS = frozenset(b' \t\r\n,')
+
+
+class PlayerStreamParser(object):
+    """/query/player 返回值的增量解析器：charts.sd 与 charts.dx 中的记录每读完一条就单独解码并交给 on_record，
+    不在内存中保留；其余字段在 finish() 时解码返回，charts 中的两个数组为空"""
+
+    def __init__(self, on_record: Callable[[str, Dict], None]):
+        self.on_record = on_record
+        self._skeleton = bytearray()
+        self._pending = b''  # 尚未读完的一条记录
+        # 每层容器为 [类型, 当前的键, 是否在等待键]
+        self._stack: List[list] = []
+        self._in_string = False
+        self._string_start = 0
+        self._escaped = -1  # 被反斜杠转义的字节的绝对位置
+        self._offset = 0  # 当前缓冲区第一个字节的绝对位置
+
+    def _in_records(self) -> bool:
+        stack = self._stack
+        return (len(stack) == 3 and stack[2][0] == b'[' and stack[0][1] == b'charts'
+                and stack[1][1] in (b'sd', b'dx'))
+
+    def _feed_records(self, buf: bytes, pos: int) -> int:
+        # 成绩记录是不含嵌套的对象：从 '{' 开始，第一个能让整段成为合法 JSON 的 '}' 就是它的结尾
+        kind = self._stack[1][1].decode()
+        n = len(buf)
+        while True:
+            while pos < n and buf[pos] in _SEPARATORS:
+                pos += 1
+            if pos >= n or buf[pos] != 0x7b:
+                return pos
+            end = buf.find(b'}', pos)
+            record = None
+            while end >= 0:
+                try:
+                    record = _loads(buf[pos:end + 1])
+                    break
+                except ValueError:
+                    end = buf.find(b'}', end + 1)
+            if end < 0:
+                return pos
+            self.on_record(kind, record)
+            pos = end + 1
+
+    def _feed_structure(self, buf: bytes, pos: int) -> int:
+        skeleton = self._skeleton
+        for m in _STRUCTURAL.finditer(buf, pos):
+            i = m.start()
+            if self._offset + i == self._escaped:
+                continue
+            c = buf[i]
+            if self._in_string and c != 0x22 and c != 0x5c:
+                continue
+            skeleton += buf[pos:i + 1]
+            pos = i + 1
+            if c == 0x5c:  # \
+                self._escaped = self._offset + i + 1
+            elif c == 0x22:  # "
+                if not self._in_string:
+                    self._in_string = True
+                    self._string_start = len(skeleton)
+                else:
+                    self._in_string = False
+                    top = self._stack[-1] if self._stack else None
+                    if top is not None and top[0] == b'{' and top[2]:
+                        top[1] = bytes(skeleton[self._string_start:len(skeleton) - 1])
+            elif c == 0x7b or c == 0x5b:  # { [
+                self._stack.append([buf[i:i + 1], None, c == 0x7b])
+                if self._in_records():
+                    return pos
+            elif c == 0x7d or c == 0x5d:  # } ]
+                self._stack.pop()
+            elif c == 0x2c:  # ,
+                if self._stack and self._stack[-1][0] == b'{':
+                    self._stack[-1][2] = True
+            else:  # :
+                self._stack[-1][2] = False
+        skeleton += buf[pos:]
+        return len(buf)
+
+    def feed(self, chunk: bytes):
+        buf = self._pending + chunk if self._pending else chunk
+        self._pending = b''
+        pos = 0
+        while pos < len(buf):
+            if not self._in_string and self._in_records():
+                pos = self._feed_records(buf, pos)
+                if pos < len(buf) and buf[pos] == 0x7b:
+                    # 记录还没有读完，留到下一块数据
+                    self._pending = buf[pos:]
+                    break
+                if pos < len(buf):
+                    # 记录数组的结尾 ']'
+                    self._skeleton += buf[pos:pos + 1]
+                    self._stack.pop()
+                    pos += 1
+            else:
+                pos = self._feed_structure(buf, pos)
+        self._offset += len(buf) - len(self._pending)
+
+    def finish(self) -> Dict:
+        if self._pending:
+            raise ValueError('incomplete player data')
+        return _loads(bytes(self._skeleton))
+
+
+class ProberClient(object):
+    """查分器客户端，整个进程共用一个保持长连接的 aiohttp 会话"""
+
+    def __init__(self, base_url: str = PROBER_URL, limit: int = 20, limit_per_host: int = 10,
+                 keepalive_timeout: float = 60, timeout: float = 15):
+        self.base_url = base_url.rstrip('/')
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # 没有经过 start() 时（比如在命令行里使用）在第一次请求时创建
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def start(self):
+        self.session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def query_player(self, payload: Dict) -> Tuple[int, Optional[Dict]]:
+        """返回 (状态, 数据)，状态为 400（无此玩家）或 403（禁止查询）时数据为 None，成功时状态为 0"""
+        async with self.session.post(f'{self.base_url}/query/player', json=payload) as resp:
+            if resp.status == 400:
+                return 400, None
+            if resp.status == 403:
+                return 403, None
+            return 0, await resp.json()
+
+    async def query_player_stream(self, payload: Dict,
+                                  on_record: Callable[[str, Dict], None]) -> Tuple[int, Optional[Dict]]:
+        """与 query_player 相同，但边读取边解析：每条成绩记录以 on_record('sd' 或 'dx', 记录) 的形式交出，
+        返回的数据中 charts 的两个数组为空"""
+        async with self.session.post(f'{self.base_url}/query/player', json=payload) as resp:
+            if resp.status == 400:
+                return 400, None
+            if resp.status == 403:
+                return 403, None
+            resp.raise_for_status()
+            parser = PlayerStreamParser(on_record)
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                parser.feed(chunk)
+            return 0, parser.finish()
+
+
+class PlayerRecordCache(object):
+    """按 qq 或用户名缓存玩家成绩，过期或超出容量（LRU）后淘汰；同一玩家的并发请求合并为一次查询，
+    400/403 的结果也会短暂缓存"""
+
+    def __init__(self, client: ProberClient, ttl: float = 60, negative_ttl: float = 10, maxsize: int = 256):
+        self.client = client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Hashable, Tuple[float, int, Any]] = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    @staticmethod
+    def key(payload: Dict) -> Hashable:
+        if 'qq' in payload:
+            return 'qq', str(payload['qq'])
+        return 'username', payload['username']
+
+    def invalidate(self, payload: Dict):
+        player = self.key(payload)
+        for key in [key for key in self._entries if key[1:] == player]:
+            del self._entries[key]
+
+    async def query_player(self, payload: Dict) -> Tuple[int, Optional[Dict]]:
+        """与 ProberClient.query_player 相同，返回的数据为共享对象，不要修改"""
+        return await self.query('player', payload, self.client.query_player)
+
+    async def query(self, kind: str, payload: Dict,
+                    loader: Callable[[Dict], Awaitable[Tuple[int, Any]]]) -> Tuple[int, Any]:
+        """以 (kind, 玩家) 为键缓存 loader(payload) 的结果，不同 kind 可以缓存同一玩家数据的不同解析结果"""
+        key = (kind,) + self.key(payload)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1], entry[2]
+            del self._entries[key]
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._inflight[key] = asyncio.ensure_future(self._fetch(key, payload, loader))
+        # 单个请求被取消时不影响其他等待同一结果的请求
+        return await asyncio.shield(future)
+
+    async def _fetch(self, key: Hashable, payload: Dict,
+                     loader: Callable[[Dict], Awaitable[Tuple[int, Any]]]) -> Tuple[int, Any]:
+        try:
+            status, obj = await loader(payload)
+        finally:
+            del self._inflight[key]
+        ttl = self.negative_ttl if status else self.ttl
+        if ttl > 0:
+            self._entries[key] = (time.monotonic() + ttl, status, obj)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return status, obj
+
+
+prober = ProberClient()
+player_cache = PlayerRecordCache(prober)
@@ -0,0 +1,144 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from src.libraries.maimaidx_music import MusicList, Music, normalize_title
+
+DIFF_LABELS = '绿黄红紫白'
+
+_LEVEL = re.compile(r'(?:等级)?(\d{1,2}\+?)')
+_DS = re.compile(r'(?:定数)?(\d{1,2}\.\d)(?:-(\d{1,2}\.\d))?')
+_BPM = re.compile(r'bpm(\d+(?:\.\d+)?)(?:-(\d+(?:\.\d+)?))?', re.I)
+_DIFF = re.compile(f'[{DIFF_LABELS}]+')
+_PAGE = re.compile(r'(?:p|第)(\d+)页?', re.I)
+_STYPES = {'dx': 'DX', 'sd': 'SD', '标准': 'SD'}
+
+
+class QueryPlan(NamedTuple):
+    """条件查歌解析后的查询条件，可哈希，直接作为结果缓存的键"""
+    level: Tuple[str, ...] = ()
+    ds: Optional[Tuple[float, float]] = None
+    bpm: Optional[Tuple[float, float]] = None
+    genre: Tuple[str, ...] = ()
+    stype: Optional[str] = None
+    diff: Tuple[int, ...] = ()
+
+    def __bool__(self):
+        return any(value for value in self)
+
+    def filter_args(self, music_list: MusicList) -> Dict[str, Any]:
+        # 等级、定数都用列表或区间传给 filter，这样一首歌的多个难度都会被选中
+        args: Dict[str, Any] = {}
+        if self.level:
+            args['level'] = list(self.level)
+        if self.ds is not None:
+            args['ds'] = self.ds
+        if self.bpm is not None:
+            args['bpm'] = self.bpm
+        if self.genre:
+            args['genre'] = sorted({music.genre for music in music_list
+                                    if any(g in normalize_title(music.genre) for g in self.genre)})
+        if self.stype is not None:
+            args['stype'] = self.stype
+        if self.diff:
+            args['diff'] = list(self.diff)
+        return args
+
+
+def _range(lo: str, hi: Optional[str]) -> Tuple[float, float]:
+    lo, hi = float(lo), float(hi if hi is not None else lo)
+    return (lo, hi) if lo <= hi else (hi, lo)
+
+
+def parse_query(text: str) -> Tuple[QueryPlan, int]:
+    """解析条件查歌的参数，返回 (查询条件, 页码)；无法识别的条件抛出 ValueError"""
+    level, genre, diff = [], [], set()
+    ds = bpm = stype = None
+    page = 1
+    for token in text.split():
+        lower = token.lower()
+        if m := _PAGE.fullmatch(token):
+            page = max(1, int(m.group(1)))
+        elif m := _DS.fullmatch(token):
+            ds = _range(*m.groups())
+        elif m := _LEVEL.fullmatch(token):
+            level.append(m.group(1))
+        elif m := _BPM.fullmatch(token):
+            bpm = _range(*m.groups())
+        elif lower in _STYPES:
+            stype = _STYPES[lower]
+        elif _DIFF.fullmatch(token):
+            diff.update(DIFF_LABELS.index(c) for c in token)
+        elif token.startswith('分类') and len(token) > 2:
+            genre.append(normalize_title(token[2:]))
+        else:
+            raise ValueError(f'无法识别的条件：{token}')
+    plan = QueryPlan(tuple(sorted(set(level))), ds, bpm, tuple(sorted(set(genre))), stype, tuple(sorted(diff)))
+    return plan, page
+
+
+class ChartQuery(object):
+    """条件查歌：解析结果与查询结果分别放在两个有界 LRU 中，翻页与重复查询不再重新筛选；
+    乐曲列表被整体替换后旧结果自动失效"""
+
+    def __init__(self, maxsize: int = 128, page_size: int = 20):
+        self.maxsize = maxsize
+        self.page_size = page_size
+        self._plans: OrderedDict[str, Tuple[QueryPlan, int]] = OrderedDict()
+        self._results: OrderedDict[QueryPlan, Tuple[MusicList, List[Tuple[Music, int]]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, cache: OrderedDict, key: Hashable):
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _put(self, cache: OrderedDict, key: Hashable, value):
+        with self._lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.maxsize:
+                cache.popitem(last=False)
+
+    def plan(self, text: str) -> Tuple[QueryPlan, int]:
+        text = ' '.join(text.split())
+        cached = self._get(self._plans, text)
+        if cached is None:
+            cached = parse_query(text)
+            self._put(self._plans, text, cached)
+        return cached
+
+    def charts(self, plan: QueryPlan, music_list: MusicList) -> List[Tuple[Music, int]]:
+        """满足条件的全部谱面 (乐曲, 难度下标)，按定数、歌曲 id、难度排序"""
+        cached = self._get(self._results, plan)
+        if cached is not None and cached[0] is music_list:
+            return cached[1]
+        charts = []
+        for music in music_list.filter(**plan.filter_args(music_list)):
+            diff = range(len(music.ds)) if music.diff is Ellipsis else music.diff
+            charts += [(music.music, j) for j in diff if j < len(music.ds)]
+        charts.sort(key=lambda e: (e[0].ds[e[1]], int(e[0].id), e[1]))
+        self._put(self._results, plan, (music_list, charts))
+        return charts
+
+    def query(self, text: str, music_list: MusicList) -> Tuple[List[Tuple[Music, int]], int, int]:
+        """返回 (当前页的谱面, 总数, 页码)，页码超出范围时取最后一页"""
+        plan, page = self.plan(text)
+        if not plan:
+            raise ValueError('请至少指定一个条件')
+        charts = self.charts(plan, music_list)
+        pages = max(1, (len(charts) + self.page_size - 1) // self.page_size)
+        page = min(page, pages)
+        start = (page - 1) * self.page_size
+        return charts[start:start + self.page_size], len(charts), page
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+            self._results.clear()
+
+
+chart_query = ChartQuery()
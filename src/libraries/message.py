@@ -0,0 +1,10 @@
+"""把编码好的图片包装成消息，只给插件使用；image.py 不依赖 nonebot，渲染进程与批量脚本才不会导入它"""
+from nonebot.adapters.onebot.v11 import Message, MessageSegment
+from nonebot.log import logger
+
+from src.libraries.image import EncodedImage
+
+
+def image_message(command: str, img: EncodedImage) -> Message:
+    logger.debug(f'{command} 图片编码: {img}')
+    return Message([MessageSegment("image", {"file": img.to_file()})])
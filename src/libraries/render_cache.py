@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from src.libraries.image import EncodedImage
+
+_EXTENSIONS = {'PNG': 'png', 'WEBP': 'webp', 'JPEG': 'jpg'}
+
+
+class RenderCache(object):
+    """已编码图片的缓存：键为玩家成绩、渲染种类、素材版本与编码方式的摘要，内存中按总字节数 LRU 淘汰，
+    可选同时写入磁盘。磁盘读写在线程池中进行，不阻塞事件循环；磁盘目录每隔 prune_interval 秒
+    （或写入量超过上限的十分之一时）按总大小淘汰最旧的文件，两次清理之间可能暂时超出上限"""
+
+    def __init__(self, maxbytes: int = 64 * 1024 * 1024, cache_dir: Optional[str] = None,
+                 disk_maxbytes: int = 512 * 1024 * 1024, prune_interval: float = 60):
+        self.maxbytes = maxbytes
+        self.cache_dir = cache_dir
+        self.disk_maxbytes = disk_maxbytes
+        self.prune_interval = prune_interval
+        # 内存部分只在事件循环线程中访问
+        self._entries: OrderedDict[str, EncodedImage] = OrderedDict()
+        self._bytes = 0
+        self._prune_lock = threading.Lock()
+        self._pruned_at = float('-inf')
+        self._written = 0
+
+    @staticmethod
+    def key(*parts: Hashable) -> str:
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[EncodedImage]:
+        img = self._entries.get(key)
+        if img is not None:
+            self._entries.move_to_end(key)
+            return img
+        if not self.cache_dir:
+            return None
+        img = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, self.cache_dir, key)
+        if img is not None:
+            self._remember(key, img)
+        return img
+
+    async def put(self, key: str, img: EncodedImage):
+        self._remember(key, img)
+        if self.cache_dir:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_disk, self.cache_dir, key, img)
+
+    def _read_disk(self, cache_dir: str, key: str) -> Optional[EncodedImage]:
+        for format, ext in _EXTENSIONS.items():
+            path = os.path.join(cache_dir, f'{key}.{ext}')
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            os.utime(path)
+            return EncodedImage(data, format, 0.0)
+        return None
+
+    def _write_disk(self, cache_dir: str, key: str, img: EncodedImage):
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f'{key}.{_EXTENSIONS[img.format]}')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(img.data)
+        os.replace(tmp_path, path)
+        self._written += img.size
+        if time.monotonic() - self._pruned_at >= self.prune_interval or self._written > self.disk_maxbytes / 10:
+            # 已有线程在清理时直接跳过
+            if self._prune_lock.acquire(blocking=False):
+                try:
+                    self._pruned_at = time.monotonic()
+                    self._written = 0
+                    self._prune_disk(cache_dir)
+                finally:
+                    self._prune_lock.release()
+
+    def _remember(self, key: str, img: EncodedImage):
+        if img.size > self.maxbytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[key] = img
+        self._bytes += img.size
+        while self._bytes > self.maxbytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+
+    def _prune_disk(self, cache_dir: str):
+        files = []
+        total = 0
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    st = entry.stat()
+                    files.append((st.st_mtime_ns, st.st_size, entry.path))
+                    total += st.st_size
+        if total <= self.disk_maxbytes:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_maxbytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+
+render_cache = RenderCache()
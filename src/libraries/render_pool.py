@@ -0,0 +1,72 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from PIL import Image
+
+T = TypeVar('T')
+
+
+def _init_worker(settings: Dict[str, Any]):
+    # 子进程不响应 Ctrl+C，由主进程负责关闭进程池
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Image.init()
+    from src.libraries.maimai_best_40 import preload_assets
+    preload_assets()
+    from src.libraries.cover_cache import cover_cache
+    cover_cache.cache_dir = settings.get('cover_cache_dir', cover_cache.cache_dir)
+    cover_cache.maxsize = settings.get('cover_cache_size', cover_cache.maxsize)
+
+
+def _mp_context():
+    # 进程池是在已有线程（music 刷新、别名表重载等）的进程里懒创建的，直接 fork 可能继承被持有的锁而死锁；
+    # forkserver 只在干净的服务进程里 fork，Windows 等不支持的平台用 spawn
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['__main__', 'src.libraries.maimai_best_40'])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+
+class RenderPool(object):
+    """图片渲染进程池，b40 等图片在子进程中绘制并编码，事件循环只等待结果；workers 为 0 时退化为单个线程"""
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = min(4, os.cpu_count() or 1) if workers is None else workers
+        # 传给子进程的配置，进程池创建后修改不再生效
+        self.settings: Dict[str, Any] = {}
+        self._executor: Optional[Executor] = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.workers > 0:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_mp_context(),
+                                                     initializer=_init_worker, initargs=(self.settings,))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='render')
+        return self._executor
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            # 子进程异常退出（例如被 OOM 杀掉）后整个进程池都不可用，丢掉它换一个新的再试一次
+            if self._executor is executor:
+                self._executor = None
+                executor.shutdown(wait=False, cancel_futures=True)
+            return await loop.run_in_executor(self.executor, fn, *args)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+render_pool = RenderPool()
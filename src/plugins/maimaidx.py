@@ -1,13 +1,89 @@
+import asyncio
 import re
+from typing import Optional
 
-from nonebot import on_command, on_regex
+from nonebot import on_command, on_regex, get_driver
 from nonebot.adapters import Event
 from nonebot.adapters.onebot.v11 import Message, MessageSegment
+from nonebot.log import logger
 from nonebot.params import CommandArg, EventMessage
 
+from src.libraries.cover_cache import cover_cache
 from src.libraries.image import *
-from src.libraries.maimai_best_40 import generate, generate_simple, generate_cal
+from src.libraries.message import image_message
+from src.libraries.maimaidx_alias import alias_loader
+from src.libraries.maimai_best_40 import generate, generate_simple, generate_cal, generate_recommend
 from src.libraries.maimaidx_music import *
+from src.libraries.maimaidx_query import chart_query
+from src.libraries.maimaidx_prober import prober, player_cache
+from src.libraries.render_cache import render_cache
+from src.libraries.render_pool import render_pool
+
+driver = get_driver()
+music_data_refresh_interval = getattr(driver.config, 'music_data_refresh_interval', 6 * 3600)
+music_data_refresh_task: Optional[asyncio.Task] = None
+player_cache.ttl = getattr(driver.config, 'player_cache_ttl', player_cache.ttl)
+player_cache.negative_ttl = getattr(driver.config, 'player_cache_negative_ttl', player_cache.negative_ttl)
+player_cache.maxsize = getattr(driver.config, 'player_cache_size', player_cache.maxsize)
+render_pool.workers = getattr(driver.config, 'render_workers', render_pool.workers)
+cover_cache.cache_dir = getattr(driver.config, 'cover_cache_dir', cover_cache.cache_dir)
+cover_cache.maxsize = getattr(driver.config, 'cover_cache_size', cover_cache.maxsize)
+render_pool.settings.update(cover_cache_dir=cover_cache.cache_dir, cover_cache_size=cover_cache.maxsize)
+render_cache.maxbytes = getattr(driver.config, 'render_cache_size', render_cache.maxbytes)
+render_cache.cache_dir = getattr(driver.config, 'render_cache_dir', render_cache.cache_dir)
+render_cache.disk_maxbytes = getattr(driver.config, 'render_cache_disk_size', render_cache.disk_maxbytes)
+configure_encoders(getattr(driver.config, 'image_encoding', {}))
+recommend_count = getattr(driver.config, 'recommend_count', 10)
+alias_loader.path = getattr(driver.config, 'alias_file', alias_loader.path)
+alias_reload_interval = getattr(driver.config, 'alias_reload_interval', 60)
+alias_reload_task: Optional[asyncio.Task] = None
+chart_query.maxsize = getattr(driver.config, 'chart_query_cache_size', chart_query.maxsize)
+chart_query.page_size = getattr(driver.config, 'chart_query_page_size', chart_query.page_size)
+
+
+async def refresh_music_data():
+    while True:
+        try:
+            if await music_data_loader.refresh():
+                logger.info(f"乐曲数据已更新，共 {len(get_total_list())} 首")
+                if music_data_loader.snapshot_error is not None:
+                    logger.warning(f"乐曲数据快照写入失败：{music_data_loader.snapshot_error!r}")
+        except Exception as e:
+            logger.warning(f"乐曲数据更新失败：{e!r}")
+        await asyncio.sleep(music_data_refresh_interval)
+
+
+async def reload_aliases():
+    while True:
+        try:
+            if await alias_loader.refresh():
+                logger.info(f"别名表已加载，共 {len(alias_loader.index)} 个别名")
+                if alias_loader.index.unresolved:
+                    logger.warning(f"别名表中有 {len(alias_loader.index.unresolved)} 首乐曲未找到："
+                                   f"{'、'.join(alias_loader.index.unresolved[:10])}")
+        except Exception as e:
+            logger.warning(f"别名表加载失败：{e!r}")
+        await asyncio.sleep(alias_reload_interval)
+
+
+@driver.on_startup
+async def _():
+    global music_data_refresh_task, alias_reload_task
+    if music_data_loader.snapshot_error is not None:
+        logger.warning(f"乐曲数据快照读取失败，将重新下载：{music_data_loader.snapshot_error!r}")
+    music_data_refresh_task = asyncio.create_task(refresh_music_data())
+    alias_reload_task = asyncio.create_task(reload_aliases())
+    await prober.start()
+
+
+@driver.on_shutdown
+async def _():
+    if music_data_refresh_task is not None:
+        music_data_refresh_task.cancel()
+    if alias_reload_task is not None:
+        alias_reload_task.cancel()
+    await prober.close()
+    render_pool.shutdown()
 
 
 def song_txt(music: Music):
@@ -27,13 +103,8 @@ def song_txt(music: Music):
 def inner_level_q(ds1, ds2=None):
     result_set = []
     diff_label = ['Bas', 'Adv', 'Exp', 'Mst', 'ReM']
-    if ds2 is not None:
-        music_data = total_list.filter(ds=(ds1, ds2))
-    else:
-        music_data = total_list.filter(ds=ds1)
-    for music in sorted(music_data, key=lambda _: int(_['id'])):
-        for i in music.diff:
-            result_set.append((music['id'], music['title'], music['ds'][i], diff_label[i], music['level'][i]))
+    for music, i in get_total_list().ds_index.query(ds1, ds2):
+        result_set.append((music['id'], music['title'], music['ds'][i], diff_label[i], music['level'][i]))
     return result_set
 
 
@@ -46,18 +117,65 @@ async def _(message: Message = CommandArg()):
     if len(argv) > 2 or len(argv) == 0:
         await inner_level.finish("命令格式为\n定数查歌 <定数>\n定数查歌 <定数下限> <定数上限>")
         return
-    if len(argv) == 1:
-        result_set = inner_level_q(float(argv[0]))
-    else:
-        result_set = inner_level_q(float(argv[0]), float(argv[1]))
-    if len(result_set) > 50:
-        await inner_level.finish(f"结果过多（{len(result_set)} 条），请缩小搜索范围。")
+    ds_range = [float(arg) for arg in argv]
+    count = get_total_list().ds_index.count(*ds_range)
+    if count > 50:
+        await inner_level.finish(f"结果过多（{count} 条），请缩小搜索范围。")
         return
+    result_set = inner_level_q(*ds_range)
     s = ""
     for elem in result_set:
         s += f"{elem[0]}. {elem[1]} {elem[3]} {elem[4]}({elem[2]})\n"
     await inner_level.finish(s.strip())
 
+spec_rand = on_regex(r"^随个(?:dx|sd|标准)?[绿黄红紫白]?(?:[0-9]+\+?)?(?:\s*分类.+)?$", flags=re.I)
+
+
+@spec_rand.handle()
+async def _(message: Message = EventMessage()):
+    regex = "随个(dx|sd|标准)?([绿黄红紫白]?)([0-9]+\\+?)?(?:\\s*分类(.+))?"
+    groups = re.match(regex, str(message).strip().lower()).groups()
+    stype = {'dx': 'DX', 'sd': 'SD', '标准': 'SD'}.get(groups[0], ...)
+    diff = '绿黄红紫白'.index(groups[1]) if groups[1] else ...
+    level = groups[2] or ...
+    genre = ...
+    music_list = get_total_list()
+    if groups[3]:
+        keyword = normalize_title(groups[3].strip())
+        genre = [g for g in {music.genre for music in music_list} if keyword in normalize_title(g)]
+    chart = music_list.random_chart(level=level, diff=diff, stype=stype, genre=genre)
+    if chart is None:
+        await spec_rand.finish("没有这样的乐曲哦。")
+    music, level_index = chart
+    await spec_rand.finish(Message([MessageSegment("text", {"text": f"{'绿黄红紫白'[level_index]} "})])
+                           + song_txt(music))
+
+
+query_charts = on_command('条件查歌')
+
+
+@query_charts.handle()
+async def _(message: Message = CommandArg()):
+    argv = str(message).strip()
+    if argv == "":
+        await query_charts.finish("命令格式为\n条件查歌 <条件> [p页码]\n"
+                                  "条件可以组合：等级（13+）、定数（13.0 或 13.0-13.5）、bpm（bpm180 或 bpm150-200）、"
+                                  "类型（DX/SD）、难度（绿黄红紫白）、分类（分类東方）\n例如：条件查歌 13+ DX 紫 p2")
+    try:
+        charts, total, page = chart_query.query(argv, get_total_list())
+    except ValueError as e:
+        await query_charts.finish(str(e))
+        return
+    if total == 0:
+        await query_charts.finish("没有符合条件的谱面。")
+    diff_label = ['Bas', 'Adv', 'Exp', 'Mst', 'ReM']
+    pages = (total + chart_query.page_size - 1) // chart_query.page_size
+    s = f"共 {total} 个谱面，第 {page}/{pages} 页：\n"
+    for music, i in charts:
+        s += f"{music['id']}. {music['title']} {diff_label[i]} {music['level'][i]}({music['ds'][i]})\n"
+    await query_charts.finish(s.strip())
+
+
 search_music = on_regex(r"^查歌.+")
 
 @search_music.handle()
@@ -66,9 +184,17 @@ async def _(message: Message = EventMessage()):
     name = re.match(regex, str(message)).groups()[0].strip()
     if name == "":
         return
-    res = total_list.filter(title_search=name)
+    title_index = get_total_list().title_index
+    res = title_index.search(name)
     if len(res) == 0:
-        await search_music.send("木得。")
+        guess = title_index.fuzzy_search(name, 5)
+        if len(guess) == 0:
+            await search_music.send("木得。")
+            return
+        search_result = ""
+        for music, _ in guess:
+            search_result += f"{music['id']}. {music['title']}\n"
+        await search_music.finish(f"没有完全匹配的乐曲，你要找的可能是：\n{search_result.strip()}")
     elif len(res) < 50:
         search_result = ""
         for music in sorted(res, key=lambda i: int(i['id'])):
@@ -81,6 +207,35 @@ async def _(message: Message = EventMessage()):
         await search_music.send(f"结果过多（{len(res)} 条），请缩小查询范围。")
 
 
+find_song = on_regex(r".+是什么歌$")
+
+
+@find_song.handle()
+async def _(message: Message = EventMessage()):
+    regex = "(.+)是什么歌"
+    name = re.match(regex, str(message)).groups()[0].strip()
+    if name == "":
+        return
+    music_list = get_total_list()
+    # 别名表在后台重建，id 可能暂时不在当前乐曲列表中
+    musics = [music for music in map(music_list.by_id, alias_loader.lookup(name)) if music is not None]
+    if len(musics) == 0:
+        guess = [music for music in map(music_list.by_id, alias_loader.complete(name, 5)) if music is not None]
+        if len(guess) == 0:
+            await find_song.finish("未找到此歌曲")
+        search_result = ""
+        for music in guess:
+            search_result += f"{music['id']}. {music['title']}\n"
+        await find_song.finish(f"没有完全匹配的别名，你要找的可能是：\n{search_result.strip()}")
+    elif len(musics) == 1:
+        await find_song.finish(Message([MessageSegment("text", {"text": "您要找的是不是 "})]) + song_txt(musics[0]))
+    else:
+        search_result = ""
+        for music in musics:
+            search_result += f"{music['id']}. {music['title']}\n"
+        await find_song.finish(f"您要找的可能是以下歌曲中的其中一首：\n{search_result.strip()}")
+
+
 query_chart = on_regex(r"^([绿黄红紫白]?)id([0-9]+)")
 
 
@@ -94,7 +249,7 @@ async def _(message: Message = EventMessage()):
             level_index = level_labels.index(groups[0])
             level_name = ['Basic', 'Advanced', 'Expert', 'Master', 'Re: MASTER']
             name = groups[1]
-            music = total_list.by_id(name)
+            music = get_total_list().by_id(name)
             chart = music['charts'][level_index]
             ds = music['ds'][level_index]
             level = music['level'][level_index]
@@ -129,7 +284,7 @@ BREAK: {chart['notes'][4]}
             await query_chart.send("未找到该谱面")
     else:
         name = groups[1]
-        music = total_list.by_id(name)
+        music = get_total_list().by_id(name)
         try:
             file = f"https://www.diving-fish.com/covers/{get_cover_len4_id(music['id'])}.png"
             await query_chart.send(Message([
@@ -157,8 +312,9 @@ async def _(message: Message = CommandArg()):
     argv = str(message).strip().split(" ")
     if len(argv) == 1 and argv[0] == '帮助':
         s = '''此功能为查找某首歌分数线设计。
-命令格式：分数线 <难度+歌曲id> <分数线>
+命令格式：分数线 <难度+歌曲id> <分数线> [分数线...]
 例如：分数线 紫799 100
+一次给出多个分数线时会一并列出，例如：分数线 紫799 100 100.5 101
 命令将返回分数线允许的 TAP GREAT 容错以及 BREAK 50落等价的 TAP GREAT 数。
 以下为 TAP GREAT 的对应表：
 GREAT/GOOD/MISS
@@ -167,35 +323,37 @@ HOLD\t2/5/10
 SLIDE\t3/7.5/15
 TOUCH\t1/2.5/5
 BREAK\t5/12.5/25(外加200落)'''
-        await query_score.send(Message([
-            MessageSegment("image", {
-                "file": f"base64://{str(image_to_base64(text_to_image(s)), encoding='utf-8')}"
-            })
-        ]))
-    elif len(argv) == 2:
+        await query_score.send(image_message('分数线', encoder_for('分数线').encode(text_to_image(s))))
+    elif len(argv) >= 2:
         try:
             grp = re.match(r, argv[0]).groups()
             level_labels = ['绿', '黄', '红', '紫', '白']
             level_labels2 = ['Basic', 'Advanced', 'Expert', 'Master', 'Re:MASTER']
             level_index = level_labels.index(grp[0])
             chart_id = grp[2]
-            line = float(argv[1])
-            music = total_list.by_id(chart_id)
-            chart: Dict[Any] = music['charts'][level_index]
-            tap = int(chart['notes'][0])
-            slide = int(chart['notes'][2])
-            hold = int(chart['notes'][1])
-            touch = int(chart['notes'][3]) if len(chart['notes']) == 5 else 0
-            brk = int(chart['notes'][-1])
-            total_score = 500 * tap + slide * 1500 + hold * 1000 + touch * 500 + brk * 2500
-            break_bonus = 0.01 / brk
-            break_50_reduce = total_score * break_bonus / 4
-            reduce = 101 - line
-            if reduce <= 0 or reduce >= 101:
+            lines = [float(arg) for arg in argv[1:]]
+            if any(line <= 0 or line > 101 for line in lines):
                 raise ValueError
-            await query_chart.send(f'''{music['title']} {level_labels2[level_index]}
-分数线 {line}% 允许的最多 TAP GREAT 数量为 {(total_score * reduce / 10000):.2f}(每个-{10000 / total_score:.4f}%),
-BREAK 50落(一共{brk}个)等价于 {(break_50_reduce / 100):.3f} 个 TAP GREAT(-{break_50_reduce / total_score * 100:.4f}%)''')
+            music_list = get_total_list()
+            table = music_list.score_table
+            row = table.row(chart_id, level_index)
+            if row is None:
+                raise ValueError
+            music = music_list.by_id(chart_id)
+            brk = table.notes[row, 4]
+            tolerance = table.tolerance(row, lines)
+            if len(lines) == 1:
+                await query_chart.send(f'''{music['title']} {level_labels2[level_index]}
+分数线 {lines[0]}% 允许的最多 TAP GREAT 数量为 {tolerance[0]:.2f}(每个-{table.tap_great[row]:.4f}%),
+BREAK 50落(一共{brk}个)等价于 {(table.break_50[row] / 100):.3f} 个 TAP GREAT(-{table.break_50_loss[row]:.4f}%)''')
+            else:
+                s = f"{music['title']} {level_labels2[level_index]}\n"
+                for line, count in zip(lines, tolerance):
+                    s += f"分数线 {line}% 允许的最多 TAP GREAT 数量为 {count:.2f}\n"
+                s += f"每个 TAP GREAT -{table.tap_great[row]:.4f}%，" \
+                     f"BREAK 50落(一共{brk}个)等价于 {(table.break_50[row] / 100):.3f} 个 TAP GREAT(-{table.break_50_loss[row]:.4f}%)，" \
+                     f"BREAK GREAT 等价于 {(table.break_great[row] / 100):.3f} 个 TAP GREAT"
+                await query_chart.send(s)
         except Exception:
             await query_chart.send("格式错误，输入“分数线 帮助”以查看帮助信息")
 
@@ -215,11 +373,7 @@ async def _(event: Event, message: Message = CommandArg()):
     elif success == 403:
         await best_40_pic.send("该用户禁止了其他人获取数据。")
     else:
-        await best_40_pic.send(Message([
-            MessageSegment("image", {
-                "file": f"base64://{str(image_to_base64(img), encoding='utf-8')}"
-            })
-        ]))
+        await best_40_pic.send(image_message('b40', img))
 
 
 best_40_simple = on_command('sb40')
@@ -236,11 +390,7 @@ async def _(event: Event, message: Message = CommandArg()):
     elif success == 403:
         await best_40_simple.send("该用户禁止了其他人获取数据。")
     else:
-        await best_40_simple.send(Message([
-            MessageSegment("image", {
-                "file": f"base64://{str(image_to_base64(img), encoding='utf-8')}"
-            })
-        ]))
+        await best_40_simple.send(image_message('sb40', img))
 
 cal = on_command('cal')
 @cal.handle()
@@ -250,17 +400,39 @@ async def _(event: Event, message: Message = CommandArg()):
         payload = {'qq': str(event.get_user_id())}
     else:
         payload = {'username': username}
-    pngStr,success = await generate_cal(payload)
+    img, success = await generate_cal(payload)
     if success == 400:
         await cal.send("未找到此玩家，请确保此玩家的用户名和查分器中的用户名相同。")
     elif success == 403:
         await cal.send("该用户禁止了其他人获取数据。")
     else:
-        await cal.send(Message([
-            MessageSegment("image", {
-                "file": f"base64://{pngStr}"
-            })
-        ]))
+        await cal.send(image_message('cal', img))
+
+
+recommend = on_command('推分')
+@recommend.handle()
+async def _(event: Event, message: Message = CommandArg()):
+    username = str(message).strip()
+    if username == "":
+        payload = {'qq': str(event.get_user_id())}
+    else:
+        payload = {'username': username}
+    result, success = await generate_recommend(payload, recommend_count)
+    if success == 400:
+        await recommend.send("未找到此玩家，请确保此玩家的用户名和查分器中的用户名相同。")
+    elif success == 403:
+        await recommend.send("该用户禁止了其他人获取数据。")
+    else:
+        obj, charts = result
+        if len(charts) == 0:
+            await recommend.send("没有可以推分的谱面了。")
+            return
+        level_labels = ['绿', '黄', '红', '紫', '白']
+        s = f"{obj['nickname']} 最容易推分的谱面：\n"
+        for music, level_index, current, target, target_ra, gain in charts:
+            s += f"{level_labels[level_index]}{music.id}. {music.title}({music.ds[level_index]}) " \
+                 f"{current:.4f}% -> {target:.4f}% (rating {target_ra}, +{gain})\n"
+        await recommend.send(s.strip())
 
 
 best_50_pic = on_command('b50')
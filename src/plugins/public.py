@@ -4,6 +4,7 @@ from nonebot.exception import IgnoredException
 from nonebot.message import event_preprocessor
 
 from src.libraries.image import *
+from src.libraries.message import image_message
 
 
 @event_preprocessor
@@ -23,14 +24,13 @@ async def _():
 <歌曲别名>是什么歌 查询乐曲别名对应的乐曲
 定数查歌 <定数>  查询定数对应的乐曲
 定数查歌 <定数下限> <定数上限>
+随个[dx/标准][绿黄红紫白]<难度> [分类<分类名>] 随机一首指定条件的乐曲
+条件查歌 <条件> [p页码] 按等级、定数、bpm、类型、难度、分类组合查询谱面
 sb40 简洁版B40查询
 b40 正常B40查询
+推分 [用户名] 查询提升 B40 所需达成率最少的谱面
 分数线 <难度+歌曲id> <分数线> 详情请输入“分数线 帮助”查看'''
-    await getHelp.send(Message([
-        MessageSegment("image", {
-            "file": f"base64://{str(image_to_base64(text_to_image(help_str)), encoding='utf-8')}"
-        })
-    ]))
+    await getHelp.send(image_message('help', encoder_for('help').encode(text_to_image(help_str))))
 
 
 async def _group_poke(bot: Bot, event: Event) -> bool:
@@ -0,0 +1,22 @@
+from src.libraries.maimaidx_alias import AliasIndex, read_alias_file
+from src.libraries.maimaidx_music import build_music_list
+
+from test_music_snapshot import MUSIC_DATA
+
+
+def test_titles_without_alias_file():
+    index = AliasIndex([], build_music_list(MUSIC_DATA))
+    assert index.lookup('LOVE') == ['8']
+    assert index.lookup('てすと') == ['11000']
+    assert index.complete('lo') == ['8']
+    assert index.lookup('爱') == []
+
+
+def test_alias_file(tmp_path):
+    path = tmp_path / 'aliases.tsv'
+    path.write_text('# 乐曲 id 或标题\t别名\n8\t爱\tlove\nテスト\t测试\n404\t不存在\n', encoding='utf-8')
+    index = AliasIndex(read_alias_file(str(path)), build_music_list(MUSIC_DATA))
+    assert index.lookup('爱') == ['8']
+    assert index.lookup('ＬＯＶＥ') == ['8']
+    assert index.lookup('测试') == ['11000']
+    assert index.unresolved == ['404']
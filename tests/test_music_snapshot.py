@@ -0,0 +1,122 @@
+import asyncio
+import copy
+import json
+import struct
+
+from aiohttp import web
+
+from src.libraries.maimaidx_music import MusicDataLoader, MusicSnapshot, build_music_list
+
+MUSIC_DATA = [
+    {
+        "id": "8", "title": "ＬＯＶＥ", "type": "SD",
+        "ds": [5.6, 5.6, 7.9, 13], "level": ["5", "5", "7+", "13"], "cids": [3585, 7531, 4748, 353],
+        "charts": [
+            {"notes": [506, 34, 92, 30], "charter": "-"},
+            {"notes": [375, 3, 2, 4], "charter": "-"},
+            {"notes": [440, 27, 54, 4], "charter": "はっぴー"},
+            {"notes": [498, 63, 70, 30], "charter": "ロシェ@ペンギン", "video": "abc"},
+        ],
+        "basic_info": {"title": "ＬＯＶＥ", "artist": "sasakure.UK", "genre": "maimai", "bpm": 150,
+                       "release_date": "", "from": "maimai", "is_new": False},
+    },
+    {
+        "id": "11000", "title": "テスト", "type": "DX",
+        "ds": [3.0, 7.2, 10.5, 13.4, 14.6], "level": ["3", "7", "10+", "13", "14+"],
+        "cids": [1, 2, 3, 4, 5],
+        "charts": [
+            {"notes": [100, 10, 10, 10, 5], "charter": "-"},
+            {"notes": [200, 20, 20, 20, 10], "charter": "-"},
+            {"notes": [300, 30, 30, 30, 15], "charter": "A"},
+            {"notes": [400, 40, 40, 40, 20], "charter": "B"},
+            {"notes": [500, 50, 50, 50, 25], "charter": "A"},
+        ],
+        "basic_info": {"title": "テスト", "artist": "誰か", "genre": "ゲーム＆バラエティ", "bpm": 172.5,
+                       "release_date": "20230101", "from": "maimai でらっくす", "is_new": True, "jacket": 7},
+        "alias": ["test", "てすと"],
+    },
+]
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'music_data.bin')
+    MusicSnapshot.from_json(copy.deepcopy(MUSIC_DATA), {'etag': 'W/"1"'}).dump(path)
+    with MusicSnapshot.load(path) as snapshot:
+        obj, meta = snapshot.to_json(), snapshot.meta
+    assert obj == MUSIC_DATA
+    assert meta == {'etag': 'W/"1"'}
+    # 整数 bpm 保持为 int，4 键谱面不会多出 TOUCH
+    assert isinstance(obj[0]['basic_info']['bpm'], int)
+    assert isinstance(obj[1]['basic_info']['bpm'], float)
+    assert [len(chart['notes']) for chart in obj[0]['charts']] == [4, 4, 4, 4]
+
+
+def test_loader_builds_same_music_list(tmp_path):
+    path = str(tmp_path / 'music_data.bin')
+    MusicSnapshot.from_json(copy.deepcopy(MUSIC_DATA)).dump(path)
+    loader = MusicDataLoader(snapshot_path=path)
+    assert loader.load_snapshot()
+    expected = build_music_list(copy.deepcopy(MUSIC_DATA))
+    assert list(loader.total_list) == list(expected)
+    music = loader.total_list.by_id('11000')
+    assert music.charts[4].touch == 50 and music['alias'] == ['test', 'てすと']
+    assert music.basic_info['jacket'] == 7
+    assert loader.total_list.by_id('8').charts[3]['video'] == 'abc'
+
+
+def test_loader_missing_snapshot(tmp_path):
+    assert not MusicDataLoader(snapshot_path=str(tmp_path / 'missing.bin')).load_snapshot()
+
+
+def test_loader_corrupt_snapshot(tmp_path):
+    header = b'{"arrays": {}}'
+    corrupt = {
+        'truncated.bin': b'MMDX\x01',
+        'no_meta.bin': struct.pack('<4sHHI', b'MMDX', 1, 0, len(header)) + header,
+        'bad_json.bin': struct.pack('<4sHHI', b'MMDX', 1, 0, 4) + b'\xff{[',
+    }
+    for name, data in corrupt.items():
+        path = tmp_path / name
+        path.write_bytes(data)
+        loader = MusicDataLoader(snapshot_path=str(path))
+        assert not loader.load_snapshot()
+        assert loader.snapshot_error is not None
+        assert len(loader.total_list) == 0
+
+
+async def _refresh_twice(loader: MusicDataLoader):
+    async def handler(request: web.Request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(body=json.dumps(MUSIC_DATA).encode(), headers={'ETag': '"v1"'})
+
+    app = web.Application()
+    app.router.add_get('/music_data', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    try:
+        port = runner.addresses[0][1]
+        loader.url = f'http://127.0.0.1:{port}/music_data'
+        return await loader.refresh(), await loader.refresh()
+    finally:
+        await runner.cleanup()
+
+
+def test_loader_refresh_writes_snapshot(tmp_path):
+    path = tmp_path / 'music_data.bin'
+    loader = MusicDataLoader(snapshot_path=str(path))
+    assert asyncio.run(_refresh_twice(loader)) == (True, False)
+    assert loader.etag == '"v1"' and loader.snapshot_error is None
+    assert [m.id for m in loader.total_list] == ['8', '11000']
+    reloaded = MusicDataLoader(snapshot_path=str(path))
+    assert reloaded.load_snapshot() and reloaded.etag == '"v1"'
+
+
+def test_loader_refresh_snapshot_write_failure(tmp_path):
+    # 快照写不进去时仍然更新数据，但不记录 ETag，下次刷新重新下载
+    loader = MusicDataLoader(snapshot_path=str(tmp_path / 'missing' / 'music_data.bin'))
+    assert asyncio.run(_refresh_twice(loader)) == (True, True)
+    assert loader.etag is None and isinstance(loader.snapshot_error, OSError)
+    assert [m.id for m in loader.total_list] == ['8', '11000']